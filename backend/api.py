@@ -2,19 +2,52 @@
 Frontend-facing API implementation. Manages user sessions and validates input.
 """
 
+import os
 import asyncio
 import logging
 
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, Depends, BackgroundTasks
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field, EmailStr
 
-from git import GitRepo, DEFAULT_BRANCH, DEFAULT_COMMIT_AUTHOR
-from utils import GitoborosException, render_readme
+from git import GitRepo, PktLine, DEFAULT_BRANCH, DEFAULT_COMMIT_AUTHOR
+from utils import (
+    GitoborosException,
+    render_readme,
+    parse_range,
+    iter_range,
+    verify_repo_id,
+)
 from contribs import GitHubUser
-from session import SessionStore, SessionData, SESSION_EXPIRY_TIME, SESSION_WAIT_TIMEOUT
+from smart_proto import (
+    GitSideBandType,
+    iter_packfile_data,
+    PACK_THREADS,
+    PACK_COMPRESSION,
+)
+from export import export_session, get_clone_path
+from session import (
+    Session,
+    SessionStore,
+    SessionData,
+    SESSION_EXPIRY_TIME,
+    SESSION_WAIT_TIMEOUT,
+)
 
 logger = logging.getLogger(__name__)
 
+# object data of a single build kept in memory, in bytes;
+# anything above is moved to a temporary file
+BUILD_SPILL_THRESHOLD = int(os.environ.get("BUILD_SPILL_THRESHOLD", 2**27))
+
+# store packfiles split into side-band-64k frames, so that they could be
+# served without any processing to clients which support it (i.e. all modern ones)
+PACK_FRAMED = os.environ.get("PACK_FRAMED", "1") == "1"
+
+# derive all generated data from the input, so that equal requests
+# produce identical packfiles, which are then built only once
+REPRODUCIBLE_BUILDS = os.environ.get("REPRODUCIBLE_BUILDS", "1") == "1"
+
 
 class MigrationRequest(BaseModel):
     """
@@ -32,10 +65,12 @@ class MigrationResponse(BaseModel):
     Migration result.
     session_id is a session ID, which represents new repo.
     session_ttl is time in seconds this repo will be available.
+    repo_path is a path to clone this repo from.
     """
 
     repo_id: str
     repo_ttl: int
+    repo_path: str
 
 
 MainAPIRouter = APIRouter(prefix="/api")
@@ -46,8 +81,47 @@ def read_main(request: Request):
     return {"message": "Hello World", "root_path": request.scope.get("root_path")}
 
 
+def build_repo(
+    username: str, email: str, branch: str, contribs: list[int], seed: str | None
+) -> GitRepo:
+    """
+    Transfer contributions to a new git repo and add README to it
+    """
+    repo = GitRepo(
+        branch,
+        threads=PACK_THREADS,
+        compressor=PACK_COMPRESSION,
+        seed=seed,
+        spill_threshold=BUILD_SPILL_THRESHOLD,
+    )
+
+    # 10MB packed for ~30K commits
+    repo.do_commits(DEFAULT_COMMIT_AUTHOR, email, "Contribution #{}", contribs)
+
+    # in reproducible mode, README is dated by the latest contribution
+    timestamp = max(contribs) if seed is not None else None
+
+    repo.add_binary("README.md", render_readme(username, branch, timestamp), timestamp)
+    repo.do_commit(DEFAULT_COMMIT_AUTHOR, email, "Added readme", timestamp)
+
+    return repo
+
+
+async def export_repo(session: Session, slogger: logging.LoggerAdapter):
+    """
+    Export repo after migration response is sent
+    """
+    # static export is optional, smart protocol works without it
+    try:
+        await export_session(session)
+    except Exception as e:
+        slogger.error(f"cannot export repo: {e}")
+
+
 @MainAPIRouter.post("/migrate")
-async def start_migration_handler(migration: MigrationRequest) -> MigrationResponse:
+async def start_migration_handler(
+    migration: MigrationRequest, background_tasks: BackgroundTasks
+) -> MigrationResponse:
     """
     This endpoint will accept migration request from the user
     """
@@ -85,8 +159,8 @@ async def start_migration_handler(migration: MigrationRequest) -> MigrationRespo
 
             slogger.info("parallel session completed, reusing the result")
         else:
-            repo = GitRepo(branch)
-            user = GitHubUser(username)
+            seed = session.get_id() if REPRODUCIBLE_BUILDS else None
+            user = GitHubUser(username, seed)
 
             slogger.info("opening session")
 
@@ -98,25 +172,56 @@ async def start_migration_handler(migration: MigrationRequest) -> MigrationRespo
             contribs = await user.get_contributions()
 
             logging.info(f"{len(contribs)} contributions found")
-            logging.info("Transferring contribs to a git repo...")
-
-            # 10MB packed for ~30K commits
-            for i, ts in enumerate(contribs):
-                repo.do_commit(DEFAULT_COMMIT_AUTHOR, email, f"Contribution #{i}", ts)
-
-            repo.add_binary("README.md", render_readme(username, branch))
-            repo.do_commit(DEFAULT_COMMIT_AUTHOR, email, "Added readme")
 
-            # count all objects and create packfile
-            all_objects = repo.get_all_objects()
-            packfile = repo.create_packfile(all_objects)
+            data, build_key = None, None
+
+            if REPRODUCIBLE_BUILDS:
+                build_key = session.make_build_key(
+                    contribs, PACK_COMPRESSION.get_levels(), PACK_FRAMED
+                )
+                data = await session.find_build(build_key)
+
+            if data is not None:
+                slogger.info(f"reusing packfile {data.pack_digest}")
+            else:
+                logging.info("Transferring contribs to a git repo...")
+
+                repo = build_repo(username, email, branch, contribs, build_key)
+
+                # no objects are added from now on, so lookup structures are
+                # compacted, and all objects are packed in the stored order
+                repo.seal()
+                total_objects = repo.get_count()
+                packfile = repo.iter_packfile_all()
+
+                if PACK_FRAMED:
+                    band = GitSideBandType.PackData.value
+                    await session.set_packfile(PktLine().frame(packfile, band))
+                else:
+                    await session.set_packfile(packfile)
+
+                # packfile checksum is known once it's completely written
+                digest = packfile.get_digest().hex()
+                await session.store_pack(digest, packfile.get_index(), PACK_FRAMED)
+
+                data = SessionData(
+                    total_objects=total_objects,
+                    total_deltas=packfile.get_deltas(),
+                    latest_object=repo.get_current(),
+                    pack_digest=digest,
+                    framed=PACK_FRAMED,
+                )
+
+                if build_key is not None:
+                    await session.set_build(build_key, data)
+
+                # packfile is stored, objects are not needed anymore
+                slogger.info(
+                    f"releasing {repo.get_size()} bytes of repo objects, "
+                    f"{repo.get_spilled_size()} bytes on disk"
+                )
+                repo.release()
 
-            # store everything
-            data = SessionData(
-                total_objects=len(all_objects),
-                latest_object=repo.get_current(),
-                packfile=packfile,
-            )
             await session.set_data(data)
 
             slogger.info("closing session")
@@ -126,7 +231,14 @@ async def start_migration_handler(migration: MigrationRequest) -> MigrationRespo
         # once valid session is requested, extend its expiration time
         await session.extend()
 
-        return MigrationResponse(repo_id=session.as_uri(), repo_ttl=SESSION_EXPIRY_TIME)
+        # writing out the packfile takes a while, so it's done in background
+        background_tasks.add_task(export_repo, session, slogger)
+
+        return MigrationResponse(
+            repo_id=session.as_uri(),
+            repo_ttl=SESSION_EXPIRY_TIME,
+            repo_path=get_clone_path(session),
+        )
 
     # pretty format and raise the error
     except Exception as e:
@@ -136,3 +248,56 @@ async def start_migration_handler(migration: MigrationRequest) -> MigrationRespo
         logger.exception(e)
 
         raise GitoborosException(400, name, value)
+
+
+@MainAPIRouter.get("/bundle/{repo_id}", dependencies=[Depends(verify_repo_id)])
+async def bundle_handler(repo_id: str, request: Request) -> StreamingResponse:
+    """
+    Download repo as a git bundle (v2), which is a short header listing refs
+    followed by the packfile. Interrupted downloads can be resumed with Range.
+    Reference: https://git-scm.com/docs/gitformat-bundle
+    """
+    session = SessionStore.create_session_from_uri(repo_id)
+    data = await session.get_data()
+
+    header = (
+        f"# v2 git bundle\n"
+        f"{data.latest_object} refs/heads/{data.branch}\n"
+        f"{data.latest_object} HEAD\n"
+        f"\n"
+    ).encode("ascii")
+
+    chunks = [header, *iter_packfile_data(data, len(data.packfile))]
+    size = sum(len(chunk) for chunk in chunks)
+
+    # bundle is identified by its packfile, which includes all the refs
+    etag = f'"{data.pack_digest}"'
+    status = 200
+    headers = {
+        "accept-ranges": "bytes",
+        "etag": etag,
+        "content-disposition": f'attachment; filename="{repo_id}.bundle"',
+    }
+
+    requested = request.headers.get("range")
+    condition = request.headers.get("if-range")
+
+    # if the bundle has changed since the previous attempt, it's sent whole
+    if requested and (condition is None or condition == etag):
+        byte_range = parse_range(requested, size)
+
+        if byte_range is not None:
+            start, end = byte_range
+            chunks = iter_range(chunks, start, end)
+            status = 206
+            headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+            size = end - start
+
+    headers["content-length"] = str(size)
+
+    return StreamingResponse(
+        chunks,
+        status_code=status,
+        headers=headers,
+        media_type="application/x-git-bundle",
+    )
@@ -0,0 +1,452 @@
+"""
+Benchmarks for the git engine. Builds synthetic repos the same way
+migration handler does and measures every stage of it. Run as:
+
+$ python benchmark.py engine --commits 30000 --readme --output before.json
+$ python benchmark.py pipelines --commits 30000
+$ python benchmark.py compression --commits 30000 --levels 1,6,9
+$ python benchmark.py asgi --commits 3000 --requests 1000
+
+Engine results are printed (or saved) as JSON, so runs of different
+versions can be compared with a plain diff. Memory is traced with tracemalloc,
+which slows everything down; pass --no-memory for more accurate timings.
+ASGI benchmark drives git endpoints of the app in-process and needs Redis,
+configured the same way as for the app itself.
+"""
+
+import sys
+import json
+import time
+import zlib
+import asyncio
+import argparse
+import platform
+import tracemalloc
+
+from contextlib import contextmanager
+
+from git import (
+    GitRepo,
+    GitIndex,
+    GitCompressor,
+    GitObjectArena,
+    GitObjectStore,
+    GitObjectType,
+    PktLine,
+    DEFAULT_BRANCH,
+    DEFAULT_COMMIT_AUTHOR,
+)
+
+BENCH_EMAIL = "benchmark@gitoboros.xyz"
+BENCH_START = 1262304000
+BENCH_STEP = 3607
+
+
+class LooseObjectArena(GitObjectArena):
+    """
+    Keeps every object compressed, as loose objects were, so that each read,
+    including the one done while packing, decompresses it again.
+    Loose object header is omitted, it's just a few bytes.
+    """
+
+    def append(self, data: bytes) -> int:
+        return super().append(zlib.compress(data))
+
+    def get(self, position: int) -> bytes:
+        return zlib.decompress(super().get(position))
+
+
+class LoosePipelineStore(GitObjectStore):
+    """
+    Emulates former object pipeline: every object is compressed in loose format
+    on hashing, then decompressed and compressed again during packing.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._objectsdata = LooseObjectArena()
+
+
+class StageTimer:
+    """
+    Collects wall time, CPU time and peak traced memory of benchmark stages
+    """
+
+    def __init__(self, trace_memory: bool):
+        self.stages = {}
+        self._trace_memory = trace_memory
+
+    @contextmanager
+    def measure(self, name: str):
+        if self._trace_memory:
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+
+        yield
+
+        result = {
+            "wall": round(time.perf_counter() - wall, 6),
+            "cpu": round(time.process_time() - cpu, 6),
+        }
+
+        if self._trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            result["peak_memory"] = peak - baseline
+
+        self.stages[name] = result
+
+
+def get_timestamps(commits: int) -> list[int]:
+    return [BENCH_START + i * BENCH_STEP for i in range(commits)]
+
+
+def run_engine(args) -> dict:
+    """
+    Build a synthetic repo stage by stage and return measurements
+    """
+    timer = StageTimer(not args.no_memory)
+    repo = GitRepo(
+        store_packed=args.store_packed,
+        threads=args.threads,
+        spill_threshold=args.spill_threshold,
+    )
+    timestamps = get_timestamps(args.commits)
+
+    if not args.no_memory:
+        tracemalloc.start()
+
+    with timer.measure("commits"):
+        repo.do_commits(
+            DEFAULT_COMMIT_AUTHOR, BENCH_EMAIL, "Contribution #{}", timestamps
+        )
+
+    with timer.measure("index"):
+        if args.readme:
+            repo.add_binary("README.md", b"# benchmark\n" * 64, BENCH_START)
+
+        for i in range(args.files):
+            path = f"contributions/{2010 + i % 16}/{i}.md"
+            repo.add_binary(path, b"contribution %d\n" % i, BENCH_START)
+
+        # serialize and parse the index back, as if it was read from disk
+        GitIndex().parse(repo._index.serialize())
+
+    with timer.measure("tree"):
+        repo.write_tree()
+        repo.do_commit(DEFAULT_COMMIT_AUTHOR, BENCH_EMAIL, "Added files", BENCH_START)
+
+    # packing is done the same way migration handler does it
+    with timer.measure("seal"):
+        repo.seal()
+
+    with timer.measure("create_pack"):
+        pack_size = len(b"".join(repo.iter_packfile_all()))
+
+    if args.store_packed:
+        with timer.measure("create_pack_fast"):
+            repo._objects.create_pack_fast()
+
+    if not args.no_memory:
+        tracemalloc.stop()
+
+    return {
+        "params": {
+            "commits": args.commits,
+            "readme": args.readme,
+            "files": args.files,
+            "store_packed": args.store_packed,
+            "threads": args.threads,
+            "spill_threshold": args.spill_threshold,
+            "memory_traced": not args.no_memory,
+        },
+        "python": platform.python_version(),
+        "objects": repo.get_count(),
+        "pack_size": pack_size,
+        "store_size": repo.get_size(),
+        "spilled_size": repo.get_spilled_size(),
+        "stages": timer.stages,
+    }
+
+
+def run_pipelines(args):
+    """
+    Compare former loose object pipeline with both storage modes
+    """
+    variants = {
+        "loose round trip": lambda: LoosePipelineStore(),
+        "raw payloads": lambda: GitObjectStore(),
+        "pack entries": lambda: GitObjectStore(store_packed=True),
+    }
+
+    print(f"{'pipeline':<20}{'commits':>10}{'pack':>10}{'total':>10}")
+
+    for name, make_store in variants.items():
+        results = []
+
+        # best of several runs, since a single one is easily skewed by noise
+        for _ in range(args.repeat):
+            repo = GitRepo()
+            repo._objects = make_store()
+
+            start = time.perf_counter()
+            repo.do_commits(
+                DEFAULT_COMMIT_AUTHOR,
+                BENCH_EMAIL,
+                "Contribution #{}",
+                get_timestamps(args.commits),
+            )
+            repo.add_binary("README.md", b"benchmark\n", BENCH_START)
+            repo.do_commit(
+                DEFAULT_COMMIT_AUTHOR, BENCH_EMAIL, "Added readme", BENCH_START
+            )
+            built = time.perf_counter()
+            b"".join(repo.iter_packfile_all())
+            packed = time.perf_counter()
+
+            results.append((built - start, packed - built))
+
+        build = min(build for build, _ in results)
+        pack = min(pack for _, pack in results)
+
+        print(f"{name:<20}{build:>10.3f}{pack:>10.3f}{build + pack:>10.3f}")
+
+
+def run_compression(args):
+    """
+    Compress pack payloads of a synthetic repo with every level,
+    grouped by object type
+    """
+    repo = GitRepo()
+    repo.do_commits(
+        DEFAULT_COMMIT_AUTHOR,
+        BENCH_EMAIL,
+        "Contribution #{}",
+        get_timestamps(args.commits),
+    )
+    repo.add_binary("README.md", b"# benchmark\n" * 64, BENCH_START)
+    repo.do_commit(DEFAULT_COMMIT_AUTHOR, BENCH_EMAIL, "Added readme", BENCH_START)
+
+    store = repo._objects
+    positions = sorted(store.lookup_object(sha1) for sha1 in repo.get_all_objects())
+    payloads = {obj_type.name: [] for obj_type in GitObjectType}
+
+    for position, _, base, payload in store.prepare_pack_entries(positions):
+        if base >= 0:
+            payloads[GitObjectType.ofs_delta.name].append(payload)
+        else:
+            payloads[GitObjectType(store._types[position]).name].append(payload)
+
+    print(f"backend: {GitCompressor().get_backend()}")
+    print(f"{'type':<10}{'count':>8}{'level':>6}{'time':>10}{'size':>10}")
+
+    for obj_type, items in payloads.items():
+        if not items:
+            continue
+
+        for level in args.levels:
+            compressor = GitCompressor({obj_type: level})
+
+            start = time.perf_counter()
+            size = sum(len(compressor.compress(data, obj_type)) for data in items)
+            elapsed = time.perf_counter() - start
+
+            print(
+                f"{obj_type:<10}{len(items):>8}{level:>6}" f"{elapsed:>10.3f}{size:>10}"
+            )
+
+
+async def asgi_request(
+    app, method: str, path: str, query: str, headers: dict, body: bytes
+) -> int:
+    """
+    Perform a single request to ASGI app, return response size
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode("ascii"),
+        "root_path": "",
+        "query_string": query.encode("ascii"),
+        "headers": [(k.encode("ascii"), v.encode("ascii")) for k, v in headers.items()],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+        "state": {},
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    finished = asyncio.Event()
+    size = 0
+
+    async def receive():
+        if messages:
+            return messages.pop()
+
+        await finished.wait()
+
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal size
+
+        if message["type"] == "http.response.start":
+            if message["status"] != 200:
+                raise RuntimeError(f"{method} {path}: {message['status']}")
+
+        elif message["type"] == "http.response.body":
+            size += len(message.get("body", b""))
+
+            if not message.get("more_body", False):
+                finished.set()
+
+    await app(scope, receive, send)
+
+    return size
+
+
+async def run_asgi_async(args):
+    # app modules need Redis and web dependencies, engine benchmarks don't
+    from main import app
+    from session import SessionStore, SessionData
+    from smart_proto import GitClientApp
+
+    await SessionStore.init()
+
+    # store a synthetic repo as a regular session
+    repo = GitRepo()
+    repo.do_commits(
+        DEFAULT_COMMIT_AUTHOR,
+        BENCH_EMAIL,
+        "Contribution #{}",
+        get_timestamps(args.commits),
+    )
+    objects = repo.get_all_objects()
+    packfile = repo.iter_packfile(objects)
+    packed = b"".join(packfile)
+
+    session = await SessionStore.create_session_from_data(
+        "benchmark", BENCH_EMAIL, DEFAULT_BRANCH
+    )
+    await session.set_data(
+        SessionData(
+            total_objects=len(objects),
+            total_deltas=packfile.get_deltas(),
+            latest_object=repo.get_current(),
+            packfile=packed,
+        )
+    )
+    await session.close()
+    await session.extend()
+
+    prefix = f"/repo/{session.as_uri()}"
+    command = "git-upload-pack"
+    caps = "side-band-64k ofs-delta no-progress"
+    pkt = PktLine()
+    want = pkt.write(f"want {repo.get_current()} {caps}\n")
+    requests = {
+        "info/refs": ("GET", "/info/refs", f"service={command}", {}, b""),
+        "clone": (
+            "POST",
+            f"/{command}",
+            "",
+            {
+                "content-type": f"application/x-{command}-request",
+                "accept": f"application/x-{command}-result",
+            },
+            want + pkt.write(None) + pkt.write("done\n"),
+        ),
+    }
+    stacks = {"fastapi": app, "asgi": GitClientApp(app)}
+
+    print(f"{'request':<12}{'stack':<10}{'requests':>10}{'time':>10}{'rps':>10}")
+
+    for name, (method, path, query, headers, body) in requests.items():
+        for stack, handler in stacks.items():
+            start = time.perf_counter()
+
+            for _ in range(args.requests):
+                await asgi_request(handler, method, prefix + path, query, headers, body)
+
+            elapsed = time.perf_counter() - start
+            rps = args.requests / elapsed
+
+            print(
+                f"{name:<12}{stack:<10}{args.requests:>10}{elapsed:>10.3f}{rps:>10.0f}"
+            )
+
+    await SessionStore.teardown()
+
+
+def run_asgi(args):
+    """
+    Compare git endpoints served by FastAPI stack and lean ASGI app
+    """
+    asyncio.run(run_asgi_async(args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gitoboros git engine benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    engine = commands.add_parser("engine", help="measure every build stage")
+    engine.add_argument("--commits", type=int, default=30000)
+    engine.add_argument("--readme", action="store_true", help="add README.md")
+    engine.add_argument("--files", type=int, default=0, help="extra files to add")
+    engine.add_argument("--store-packed", action="store_true")
+    engine.add_argument("--threads", type=int, default=1)
+    engine.add_argument(
+        "--spill-threshold", type=int, help="move object data to disk past this size"
+    )
+    engine.add_argument("--no-memory", action="store_true", help="skip tracemalloc")
+    engine.add_argument("--output", help="write JSON here instead of stdout")
+
+    pipelines = commands.add_parser("pipelines", help="compare object pipelines")
+    pipelines.add_argument("--commits", type=int, default=30000)
+    pipelines.add_argument("--repeat", type=int, default=3, help="best of N runs")
+
+    compression = commands.add_parser(
+        "compression", help="compare compression levels by object type"
+    )
+    compression.add_argument("--commits", type=int, default=30000)
+    compression.add_argument(
+        "--levels",
+        type=lambda value: [int(level) for level in value.split(",")],
+        default=[1, 6, 9],
+        help="comma separated zlib levels",
+    )
+
+    asgi = commands.add_parser("asgi", help="compare git endpoint stacks")
+    asgi.add_argument("--commits", type=int, default=3000)
+    asgi.add_argument("--requests", type=int, default=1000)
+
+    args = parser.parse_args()
+
+    if args.command == "pipelines":
+        run_pipelines(args)
+        return
+
+    if args.command == "compression":
+        run_compression(args)
+        return
+
+    if args.command == "asgi":
+        run_asgi(args)
+        return
+
+    result = run_engine(args)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2, sort_keys=True)
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,7 @@ import aiohttp
 import asyncio
 import functools
 import operator
-from random import randrange
+import random
 from datetime import datetime, time
 from bs4 import BeautifulSoup
 
@@ -28,9 +28,24 @@ class GitHubUser:
 
     _username = None
 
-    def __init__(self, username, *args, **kwargs):
+    def __init__(self, username, seed=None, *args, **kwargs):
+        """
+        If seed is provided, contribution times are derived from it
+        and from contribution data, so the same input yields the same result
+        """
         self._username = username
         self._session = None
+        self._seed = seed
+        self._random = random.Random()
+
+    def get_random(self, day: datetime, count: int) -> random.Random:
+        """
+        Get random generator for contributions made on a particular day
+        """
+        if self._seed is None:
+            return self._random
+
+        return random.Random(f"{self._seed}:{day.date()}:{count}")
 
     async def get_joindate(self) -> int:
         """
@@ -92,14 +107,16 @@ class GitHubUser:
                     parsed = datetime.strptime(f"{day} {month} {year}", "%d %B %Y")
 
                     # generate random contributions on that day
+                    rng = self.get_random(parsed, num_contribs)
+
                     for _ in range(int(num_contribs)):
                         timestamp = datetime(
                             year=parsed.year,
                             month=parsed.month,
                             day=parsed.day,
-                            hour=randrange(0, 24),
-                            minute=randrange(0, 60),
-                            second=randrange(0, 60),
+                            hour=rng.randrange(0, 24),
+                            minute=rng.randrange(0, 60),
+                            second=rng.randrange(0, 60),
                         )
 
                         contribs.append(int(timestamp.timestamp()))
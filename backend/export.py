@@ -0,0 +1,146 @@
+"""
+Static export of finished sessions as "dumb" HTTP git repos. Dumb protocol needs
+nothing but plain files, so the proxy can serve them (and packfiles in particular)
+directly from disk, without any request reaching the backend.
+Reference: https://git-scm.com/docs/http-protocol#_dumb_clients
+"""
+
+import os
+import time
+import shutil
+import asyncio
+import logging
+import tempfile
+
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+
+from session import Session, SessionData, SESSION_EXPIRY_TIME
+from smart_proto import iter_packfile_data, GIT_PREFIX
+
+# directory to export repos to, export is disabled if not set
+EXPORT_DIR = os.environ.get("EXPORT_DIR")
+
+# exported repos are served by the proxy under this path
+EXPORT_PREFIX = "/dumb"
+
+# expired repos are looked up this often, in seconds
+EXPORT_CLEANUP_INTERVAL = 30
+
+logger = logging.getLogger(__name__)
+
+
+def write_repo(target: str, data: SessionData, index: bytes):
+    """
+    Write repo files to a temporary directory and move it to the target at once,
+    so that the proxy never serves a partially written repo
+    """
+    name = f"pack-{data.pack_digest}"
+    root = tempfile.mkdtemp(dir=EXPORT_DIR, prefix=".export-")
+    packdir = os.path.join(root, "objects", "pack")
+
+    os.makedirs(packdir)
+    os.makedirs(os.path.join(root, "info"))
+    os.makedirs(os.path.join(root, "objects", "info"))
+
+    with open(os.path.join(packdir, name + ".pack"), "wb") as file:
+        for chunk in iter_packfile_data(data, len(data.packfile)):
+            file.write(chunk)
+
+    with open(os.path.join(packdir, name + ".idx"), "wb") as file:
+        file.write(index)
+
+    with open(os.path.join(root, "objects", "info", "packs"), "w") as file:
+        file.write(f"P {name}.pack\n\n")
+
+    with open(os.path.join(root, "info", "refs"), "w") as file:
+        file.write(f"{data.latest_object}\trefs/heads/{data.branch}\n")
+
+    with open(os.path.join(root, "HEAD"), "w") as file:
+        file.write(f"ref: refs/heads/{data.branch}\n")
+
+    # directories are created with 0700 permissions
+    os.chmod(root, 0o755)
+
+    # same session may be exported again with a new packfile. Previous export
+    # is moved aside right before the new one takes its place and removed
+    # only afterwards, so it's never served partially removed or lost
+    previous = None
+
+    if os.path.exists(target):
+        # empty directory is replaced by rename
+        previous = tempfile.mkdtemp(dir=EXPORT_DIR, prefix=".previous-")
+        os.rename(target, previous)
+
+    os.rename(root, target)
+
+    if previous is not None:
+        shutil.rmtree(previous)
+
+
+def get_clone_path(session: Session) -> str:
+    """
+    Return path clients should clone session repo from. Exported repos are
+    sent by the proxy, which falls back to the backend until export is done.
+    """
+    prefix = GIT_PREFIX if EXPORT_DIR is None else EXPORT_PREFIX
+
+    return f"{prefix}/{session.as_uri()}"
+
+
+async def export_session(session: Session):
+    """
+    Export session repo, unless it's already exported with the same packfile.
+    Export time is updated on every call and used to expire the repo.
+    """
+    if EXPORT_DIR is None:
+        return
+
+    data = await session.get_metadata()
+    target = os.path.join(EXPORT_DIR, session.as_uri())
+    pack = os.path.join(target, "objects", "pack", f"pack-{data.pack_digest}.pack")
+
+    # packfile is loaded only if it hasn't been exported yet
+    if not os.path.exists(pack):
+        data.packfile = await session.get_packfile(data.pack_digest, data.framed)
+        index = await session.get_index()
+
+        await asyncio.to_thread(write_repo, target, data, index)
+
+    os.utime(target)
+
+
+def remove_expired():
+    """
+    Remove repos which sessions have already expired
+    """
+    deadline = time.time() - SESSION_EXPIRY_TIME
+
+    for entry in os.scandir(EXPORT_DIR):
+        if entry.is_dir() and entry.stat().st_mtime < deadline:
+            logger.info(f"removing expired export {entry.name}")
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+async def cleanup():
+    """
+    Periodically remove expired repos
+    """
+    while True:
+        await asyncio.to_thread(remove_expired)
+        await asyncio.sleep(EXPORT_CLEANUP_INTERVAL)
+
+
+@asynccontextmanager
+async def ExportLifespan(app: FastAPI):
+    if EXPORT_DIR is None:
+        yield
+        return
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    task = asyncio.create_task(cleanup())
+
+    yield
+
+    task.cancel()
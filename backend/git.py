@@ -15,195 +15,1590 @@ https://github.com/dvdotsenko/git_http_backend.py
 https://git-scm.com/docs/protocol-v2
 """
 
+import sys
+import array
 import random
 import time
+import mmap
 import zlib
 import struct
 import hashlib
+import bisect
 import operator
+import itertools
+import tempfile
 
 from enum import Enum
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import (
+    Sequence,
+    Iterable,
+    Iterator,
+    AsyncIterable,
+    AsyncIterator,
+    AbstractSet,
+)
+
+# faster zlib-compatible implementations are used if installed;
+# isal supports only a few compression levels, so they are capped
+try:
+    from zlib_ng import zlib_ng as zlib_backend
+
+    ZLIB_BACKEND_MAX_LEVEL = 9
+except ImportError:
+    try:
+        from isal import isal_zlib as zlib_backend
+
+        ZLIB_BACKEND_MAX_LEVEL = 3
+    except ImportError:
+        zlib_backend = zlib
+        ZLIB_BACKEND_MAX_LEVEL = 9
+
+DEFAULT_BRANCH = "main"
+DEFAULT_COMMIT_AUTHOR = "Gitoboros"
+
+# largest pkt-line, including its 4-byte length header
+PKTLINE_MAX_SIZE = 65520
+
+# longest chain of deltas in generated packs, same as git's default pack.depth;
+# deeper chains make clients resolve too many deltas to read a single commit
+DELTA_MAX_DEPTH = 50
+
+# "PACK" signature, version and number of objects
+PACK_HEADER_SIZE = 12
+
+# pack entries are decompressed by reading this much data at once
+PACK_READ_CHUNK = 4096
+
+# resolved objects kept by pack reader, so that walking along
+# a delta chain doesn't resolve it from the very beginning every time
+PACK_READ_CACHE = 256
+
+# packs with fewer objects are always compressed in a single thread
+PACK_THREADED_MIN = 8192
+
+# number of objects handed to compression threads at once
+PACK_BATCH_SIZE = 4096
+
+# fixed-size part of index entry, path follows it
+INDEX_ENTRY_FORMAT = "!LLLLLLLLLL20sH"
+
+
+class GitError(Exception):
+    """
+    Git operation error
+    """
+
+    pass
+
+
+class PktLine:
+    """
+    Encode/decode data according to pkt-line format.
+    Reference: https://git-scm.com/docs/protocol-common
+    """
+
+    def write(self, data: bytes | str | None) -> bytes:
+        """
+        Write binary data as pkt-line
+        """
+        if data is None:
+            return b"0000"
+
+        size = len(data) + 4
+        header = f"{size:04x}".encode("ascii")
+
+        if size > PKTLINE_MAX_SIZE:
+            raise GitError("pktline data too big")
+
+        return header + (data.encode("ascii") if isinstance(data, str) else data)
+
+    def frame(
+        self,
+        chunks: Iterable[bytes],
+        prefix: bytes = b"",
+        size: int = PKTLINE_MAX_SIZE,
+    ) -> Iterator[bytes]:
+        """
+        Split a stream of binary data into pkt-lines of given size, including
+        header and prefix (like sideband type); only the last one may be shorter
+        """
+        payload_size = size - 4 - len(prefix)
+        header = f"{size:04x}".encode("ascii") + prefix
+        buffer = bytearray()
+
+        for chunk in chunks:
+            buffer += chunk
+
+            if len(buffer) < payload_size:
+                continue
+
+            framed = bytearray()
+            view = memoryview(buffer)
+            end = len(buffer) - len(buffer) % payload_size
+
+            for i in range(0, end, payload_size):
+                framed += header
+                framed += view[i : i + payload_size]
+
+            view.release()
+            del buffer[:end]
+
+            yield bytes(framed)
+
+        if buffer:
+            yield self.write(prefix + buffer)
+
+    def parse(self, data: bytes) -> list[str]:
+        """
+        Read a stream of pkt-line data and return a list of parsed lines
+        """
+        reader = PktLineReader()
+        lines = []
+
+        for kind, line in reader.feed(data):
+            # don't append flush pkts
+            if kind == PktLineType.data and line:
+                lines.append(bytes(line).decode("ascii").replace("\n", ""))
+
+        reader.close()
+
+        return lines
+
+
+class PktLineType(Enum):
+    """
+    Kinds of pkt-lines. Special packets are identified by their length
+    and carry no payload.
+    """
+
+    data = None
+    flush = 0
+    delim = 1
+    response_end = 2
+
+
+class PktLineReader:
+    """
+    Incremental pkt-line parser. Data is fed in chunks as it arrives and complete
+    lines are returned as memoryview slices of the received chunks, so neither
+    payloads are copied nor decoded. Only an incomplete trailing line is kept
+    until the next chunk.
+    """
+
+    def __init__(self):
+        self._pending = b""
+
+    def feed(self, chunk: bytes) -> list[tuple[PktLineType, memoryview]]:
+        """
+        Parse next chunk of data and return complete pkt-lines
+        """
+        data = self._pending + chunk if self._pending else chunk
+        view = memoryview(data)
+        lines = []
+        i = 0
+
+        while len(data) - i >= 4:
+            try:
+                size = int(bytes(view[i : i + 4]), 16)
+            except ValueError:
+                raise GitError("invalid pkt-line length")
+
+            if size < 4:
+                try:
+                    kind = PktLineType(size)
+                except ValueError:
+                    raise GitError(f"invalid pkt-line length {size}")
+
+                lines.append((kind, view[i + 4 : i + 4]))
+                i += 4
+                continue
+
+            # wait for the rest of the line
+            if len(data) - i < size:
+                break
+
+            lines.append((PktLineType.data, view[i + 4 : i + size]))
+            i += size
+
+        # only an incomplete line is copied
+        self._pending = bytes(view[i:])
+
+        return lines
+
+    def close(self):
+        """
+        Ensure that all received data has been parsed
+        """
+        if self._pending:
+            raise GitError("truncated pkt-line")
+
+    async def read(
+        self, stream: AsyncIterable[bytes]
+    ) -> AsyncIterator[tuple[PktLineType, memoryview]]:
+        """
+        Parse pkt-lines from an async stream of chunks, like ASGI request body
+        """
+        async for chunk in stream:
+            for line in self.feed(chunk):
+                yield line
+
+        self.close()
+
+
+class GitObjectType(Enum):
+    """
+    Supported git object types
+    """
+
+    commit = 1
+    tree = 2
+    blob = 3
+    ofs_delta = 6
+
+
+class GitDelta:
+    """
+    Create and apply deltas in git pack format: a sequence of instructions
+    which either copy a range of the base object or insert new data.
+    Reference: https://git-scm.com/docs/pack-format#_deltified_representation
+    """
+
+    # shortest part of a line worth a copy instruction
+    MIN_COPY = 6
+
+    # biggest copy which can be encoded without relying on 0x10000 special case
+    MAX_COPY = 0xFFFF
+
+    # biggest insert instruction
+    MAX_INSERT = 0x7F
+
+    def encode_size(self, size: int) -> bytes:
+        """
+        Encode object size as a little-endian base-128 number
+        """
+        byte = size & 0x7F
+        size >>= 7
+        header = []
+
+        while size:
+            header.append(byte | 0x80)
+            byte = size & 0x7F
+            size >>= 7
+        header.append(byte)
+
+        return bytes(header)
+
+    def decode_size(self, delta: bytes, i: int) -> tuple[int, int]:
+        """
+        Decode object size starting at given position,
+        return the size and position right after it
+        """
+        size = 0
+        shift = 0
+
+        while True:
+            byte = delta[i]
+            size |= (byte & 0x7F) << shift
+            shift += 7
+            i += 1
+
+            if not byte & 0x80:
+                return size, i
+
+    def encode_copy(self, offset: int, size: int) -> bytes:
+        """
+        Encode copy instruction; only non-zero bytes of offset and size are stored
+        """
+        opcode = 0x80
+        args = []
+
+        for shift, value in ((0, offset), (4, size)):
+            while value:
+                byte = value & 0xFF
+
+                if byte:
+                    opcode |= 1 << shift
+                    args.append(byte)
+
+                value >>= 8
+                shift += 1
+
+        return bytes([opcode] + args)
+
+    def encode_insert(self, data: bytes) -> bytes:
+        """
+        Encode insert instructions for given literal data
+        """
+        instructions = []
+
+        for i in range(0, len(data), self.MAX_INSERT):
+            chunk = data[i : i + self.MAX_INSERT]
+            instructions.append(bytes([len(chunk)]) + chunk)
+
+        return b"".join(instructions)
+
+    def common_prefix(self, a: bytes, b: bytes) -> int:
+        """
+        Return length of the common prefix of two byte strings
+        """
+        size = min(len(a), len(b))
+        diff = int.from_bytes(a[:size], "big") ^ int.from_bytes(b[:size], "big")
+
+        return size - (diff.bit_length() + 7) // 8
+
+    def common_suffix(self, a: bytes, b: bytes) -> int:
+        """
+        Return length of the common suffix of two byte strings
+        """
+        size = min(len(a), len(b))
+        diff = int.from_bytes(a[-size:], "little") ^ int.from_bytes(b[-size:], "little")
+
+        return size - (diff.bit_length() + 7) // 8 if size else 0
+
+    def create(self, base: bytes, target: bytes) -> bytes:
+        """
+        Create delta which transforms base into target. Objects are expected to be
+        small, line-oriented and similar (like consecutive commits), so the search is
+        kept simple: lines found in base are copied as a whole, and other lines are
+        compared to the base line with the same number to copy common prefix and suffix.
+        """
+        base_lines = base.splitlines(keepends=True)
+        base_offsets = []
+        known = {}
+        offset = 0
+
+        for line in base_lines:
+            base_offsets.append(offset)
+            known.setdefault(line, offset)
+            offset += len(line)
+
+        # copies are (start, end) ranges of base, inserts are bytes
+        pieces = []
+
+        for i, line in enumerate(target.splitlines(keepends=True)):
+            start = known.get(line)
+
+            if start is not None:
+                pieces.append((start, start + len(line)))
+                continue
+
+            if i >= len(base_lines):
+                pieces.append(line)
+                continue
+
+            other = base_lines[i]
+            prefix = self.common_prefix(line, other)
+            suffix = self.common_suffix(line, other)
+            suffix = min(suffix, len(line) - prefix, len(other) - prefix)
+            end = base_offsets[i] + len(other)
+
+            if prefix < self.MIN_COPY:
+                prefix = 0
+
+            if suffix < self.MIN_COPY:
+                suffix = 0
+
+            if prefix:
+                pieces.append((base_offsets[i], base_offsets[i] + prefix))
+
+            pieces.append(line[prefix : len(line) - suffix])
+
+            if suffix:
+                pieces.append((end - suffix, end))
+
+        # merge contiguous pieces and encode them
+        delta = [self.encode_size(len(base)), self.encode_size(len(target))]
+        copy_start = copy_end = 0
+        literal = b""
+
+        for piece in pieces:
+            if isinstance(piece, bytes):
+                if copy_end > copy_start:
+                    delta.append(self.encode_copies(copy_start, copy_end))
+                    copy_start = copy_end = 0
+
+                literal += piece
+                continue
+
+            if literal:
+                delta.append(self.encode_insert(literal))
+                literal = b""
+            elif piece[0] == copy_end:
+                copy_end = piece[1]
+                continue
+            elif copy_end > copy_start:
+                delta.append(self.encode_copies(copy_start, copy_end))
+
+            copy_start, copy_end = piece
+
+        if copy_end > copy_start:
+            delta.append(self.encode_copies(copy_start, copy_end))
+
+        if literal:
+            delta.append(self.encode_insert(literal))
+
+        return b"".join(delta)
+
+    def encode_copies(self, start: int, end: int) -> bytes:
+        """
+        Encode copy instructions for a given range of base
+        """
+        if end - start <= self.MAX_COPY:
+            return self.encode_copy(start, end - start)
+
+        instructions = []
+
+        for i in range(start, end, self.MAX_COPY):
+            instructions.append(self.encode_copy(i, min(end - i, self.MAX_COPY)))
+
+        return b"".join(instructions)
+
+    def apply(self, base: bytes, delta: bytes) -> bytes:
+        """
+        Apply delta to the base object and return the resulting object
+        """
+        base_size, i = self.decode_size(delta, 0)
+        target_size, i = self.decode_size(delta, i)
+        target = bytearray()
+
+        if base_size != len(base):
+            raise GitError("delta base size mismatch")
+
+        while i < len(delta):
+            opcode = delta[i]
+            i += 1
+
+            if opcode & 0x80:
+                offset = 0
+                size = 0
+
+                for k in range(4):
+                    if opcode & (1 << k):
+                        offset |= delta[i] << (k * 8)
+                        i += 1
+
+                for k in range(3):
+                    if opcode & (1 << (4 + k)):
+                        size |= delta[i] << (k * 8)
+                        i += 1
+
+                target += base[offset : offset + (size or 0x10000)]
+            elif opcode:
+                target += delta[i : i + opcode]
+                i += opcode
+            else:
+                raise GitError("invalid delta instruction")
+
+        if target_size != len(target):
+            raise GitError("delta target size mismatch")
+
+        return bytes(target)
+
+
+class GitCompressor:
+    """
+    Compresses object data for packfiles. Compression level can be set
+    per object type (deltas have their own "ofs_delta" type), trading CPU time
+    for pack size.
+    """
+
+    def __init__(
+        self,
+        levels: dict[str, int] | None = None,
+        backend=None,
+    ):
+        self._backend = backend or zlib_backend
+        self._levels = {
+            obj_type.name: zlib.Z_DEFAULT_COMPRESSION for obj_type in GitObjectType
+        }
+
+        for obj_type, level in (levels or {}).items():
+            if obj_type not in self._levels:
+                raise GitError(f"unknown object type {obj_type}")
+
+            self._levels[obj_type] = min(level, ZLIB_BACKEND_MAX_LEVEL)
+
+    def get_backend(self) -> str:
+        """
+        Get name of the zlib implementation in use
+        """
+        return self._backend.__name__
+
+    def get_levels(self) -> dict[str, int]:
+        """
+        Get compression levels by object type
+        """
+        return dict(self._levels)
+
+    def compress(self, data: bytes, obj_type: str) -> bytes:
+        """
+        Compress object data of a given type
+        """
+        return self._backend.compress(data, self._levels[obj_type])
+
+
+def sort_digests(digests: bytes | bytearray) -> array.array:
+    """
+    Return indices of 20-byte digests, stored back to back, in digest order.
+    Indices are bucketed by the first byte beforehand, so that sort keys
+    exist only for a single bucket at a time.
+    """
+    buckets = [array.array("I") for _ in range(256)]
+    order = array.array("I")
+
+    for i in range(len(digests) // 20):
+        buckets[digests[i * 20]].append(i)
+
+    for bucket in buckets:
+        order.extend(sorted(bucket, key=lambda i: digests[i * 20 : i * 20 + 20]))
+
+    return order
+
+
+class GitObjectArena:
+    """
+    Append-only storage which keeps a sequence of byte records
+    in a single contiguous buffer. Records are addressed by their position.
+    If spill threshold is set, buffer is moved to a temporary file every time
+    it grows past it, and spilled records are read back through mmap.
+    """
+
+    def __init__(self, spill_threshold: int | None = None):
+        self._threshold = spill_threshold
+        self._buffer = bytearray()
+        self._offsets = array.array("Q", [0])
+
+        # number of bytes moved to the file, buffer holds the rest
+        self._spilled = 0
+        self._file = None
+        self._map = None
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def append(self, data: bytes) -> int:
+        """
+        Append a record and return its position
+        """
+        self._buffer += data
+        self._offsets.append(self._spilled + len(self._buffer))
+
+        if self._threshold is not None and len(self._buffer) >= self._threshold:
+            self.spill()
+
+        return len(self._offsets) - 2
+
+    def spill(self):
+        """
+        Move buffered records to the temporary file
+        """
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix="gitoboros-")
+
+        self._file.write(self._buffer)
+        self._file.flush()
+        self._spilled += len(self._buffer)
+        self._buffer = bytearray()
+
+    def get(self, position: int) -> bytes:
+        """
+        Return a copy of the record at a given position
+        """
+        start = self._offsets[position]
+        end = self._offsets[position + 1]
+
+        # records are spilled whole, so each one is either in file or in buffer
+        if start >= self._spilled:
+            return bytes(self._buffer[start - self._spilled : end - self._spilled])
+
+        # mapping is recreated only when it doesn't cover the requested record
+        if self._map is None or len(self._map) < end:
+            if self._map is not None:
+                self._map.close()
+
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self._map[start:end]
+
+    def get_size(self) -> int:
+        """
+        Return number of bytes occupied in memory by records and their offsets
+        """
+        return len(self._buffer) + self._offsets.itemsize * len(self._offsets)
+
+    def get_spilled_size(self) -> int:
+        """
+        Return number of bytes moved to the temporary file
+        """
+        return self._spilled
+
+    def release(self):
+        """
+        Drop all records, free the underlying buffer and remove the file
+        """
+        if self._map is not None:
+            self._map.close()
+
+        if self._file is not None:
+            self._file.close()
+
+        self._buffer = bytearray()
+        self._offsets = array.array("Q", [0])
+        self._spilled = 0
+        self._file = None
+        self._map = None
+
+
+class GitObjectStore:
+    """
+    Git object storage and handling. Objects are kept in arenas
+    and looked up by their binary (20-byte) SHA-1 digests.
+
+    Loose objects are never served, so every object is stored either
+    as a raw payload or as a ready pack entry, and compressed only once.
+    Commits are packed as deltas against the preceding commit.
+    """
+
+    def __init__(
+        self, store_packed=False, threads=1, compressor=None, spill_threshold=None
+    ):
+        """
+        If store_packed is True, compress objects to pack format on each hashing.
+        Final packfile creation will be much faster, but object creation slower.
+        Otherwise raw payloads are stored and compressed during packing,
+        using given number of threads for big packs. Defaults to False.
+        If spill_threshold is set, object data is kept in memory only up to
+        this number of bytes and moved to a temporary file after that.
+        """
+        self._storepacked = store_packed
+        self._threads = threads
+        self._compressor = compressor or GitCompressor()
+        self._delta = GitDelta()
+        self._index = {}
+        self._sorted = None
+        self._digests = bytearray()
+        self._types = array.array("B")
+        self._objectsdata = GitObjectArena(spill_threshold)
+
+        # packed entries of deltified commits don't include base offset,
+        # as it depends on the pack layout; base position is kept instead
+        self._packeddata = GitObjectArena(spill_threshold)
+        self._bases = array.array("l")
+
+        # position, data and delta depth of the last packed commit
+        self._lastcommit = None
+
+    def __len__(self) -> int:
+        return len(self._types)
+
+    def __contains__(self, sha1: str) -> bool:
+        return self.find_position(bytes.fromhex(sha1)) >= 0
+
+    def get_objects(self) -> AbstractSet[str]:
+        """
+        Return hashes of all stored objects
+        """
+        return {self.get_digest(i).hex() for i in range(len(self._types))}
+
+    def get_size(self) -> int:
+        """
+        Return approximate memory footprint of the store in bytes
+        """
+        if self._index is not None:
+            index_size = sys.getsizeof(self._index) + len(self._index) * sys.getsizeof(
+                bytes(20)
+            )
+        else:
+            index_size = self._sorted.itemsize * len(self._sorted)
+
+        index_size += len(self._digests)
+        types_size = self._types.itemsize * len(self._types)
+        bases_size = self._bases.itemsize * len(self._bases)
+        data_size = self._objectsdata.get_size() + self._packeddata.get_size()
+
+        return index_size + types_size + bases_size + data_size
+
+    def get_spilled_size(self) -> int:
+        """
+        Return number of bytes of object data moved to disk
+        """
+        return (
+            self._objectsdata.get_spilled_size() + self._packeddata.get_spilled_size()
+        )
+
+    def release(self):
+        """
+        Drop all objects. The store can be reused afterwards
+        """
+        self._index = {}
+        self._sorted = None
+        self._digests = bytearray()
+        self._types = array.array("B")
+        self._bases = array.array("l")
+        self._lastcommit = None
+        self._objectsdata.release()
+        self._packeddata.release()
+
+    def hash_object(self, data: bytes, obj_type: str) -> str:
+        """
+        Compute hash of object data of a given type and write data to the store
+        """
+        header = f"{obj_type} {len(data)}".encode("ascii")
+        sha1 = hashlib.sha1(header + b"\x00")
+        sha1.update(data)
+        digest = sha1.digest()
+
+        if self._index is None:
+            raise GitError("objects can't be added to a sealed store")
+
+        # identical objects are stored only once
+        if digest in self._index:
+            return digest.hex()
+
+        if self._storepacked:
+            position = self.store_packed_object(data, obj_type)
+        else:
+            position = self._objectsdata.append(data)
+
+        self._index[digest] = position
+        self._digests += digest
+        self._types.append(GitObjectType[obj_type].value)
+
+        return digest.hex()
+
+    def store_packed_object(self, data: bytes, obj_type: str) -> int:
+        """
+        Compress object to pack format and store it, return its position
+        """
+        base = -1
+        entry = None
+
+        if obj_type == GitObjectType.commit.name:
+            position = len(self._packeddata)
+            depth = 0
+
+            if self._lastcommit and self._lastcommit[2] < DELTA_MAX_DEPTH:
+                base, base_data, depth = self._lastcommit
+                delta = self._delta.create(base_data, data)
+                entry = self.encode_pack_object_raw(GitObjectType.ofs_delta.name, delta)
+                depth += 1
+
+            self._lastcommit = (position, data, depth)
+
+        if entry is None:
+            entry = self.encode_pack_object_raw(obj_type, data)
+
+        self._bases.append(base)
+
+        return self._packeddata.append(entry)
+
+    def seal(self):
+        """
+        Finish adding objects: replace digest dictionary, which takes over
+        a hundred bytes per object, with positions sorted by digest.
+        Objects are looked up by binary search afterwards.
+        """
+        if self._index is None:
+            return
+
+        self._index = None
+        self._sorted = sort_digests(self._digests)
+
+    def find_position(self, digest: bytes) -> int:
+        """
+        Find position of an object by its binary hash, -1 if there's none
+        """
+        if self._index is not None:
+            return self._index.get(digest, -1)
+
+        i = bisect.bisect_left(self._sorted, digest, key=self.get_digest)
+
+        if i < len(self._sorted) and self.get_digest(self._sorted[i]) == digest:
+            return self._sorted[i]
+
+        return -1
+
+    def lookup_object(self, sha1: str) -> int:
+        """
+        Lookup object by its sha1 hash and return its position in the store
+        """
+        position = self.find_position(bytes.fromhex(sha1))
+
+        if position < 0:
+            raise GitError("unknown object requested")
+
+        return position
+
+    def get_digest(self, position: int) -> bytes:
+        """
+        Get binary hash of an object at given position
+        """
+        return bytes(self._digests[position * 20 : position * 20 + 20])
+
+    def read_position(self, position: int) -> tuple[str, bytes]:
+        """
+        Return type and data of an object at given position, resolving deltas
+        """
+        obj_type = GitObjectType(self._types[position]).name
+
+        if not self._storepacked:
+            return (obj_type, self._objectsdata.get(position))
+
+        _, data = self.decode_pack_object_raw(self._packeddata.get(position))
+        base = self._bases[position]
+
+        if base >= 0:
+            data = self._delta.apply(self.read_position(base)[1], data)
+
+        return (obj_type, data)
+
+    def read_object(self, sha1: str) -> tuple[str, bytes]:
+        """
+        Lookup object by its sha1 hash and return obj data
+        """
+        return self.read_position(self.lookup_object(sha1))
+
+    def encode_pack_header(self, obj_type: str, size: int) -> bytes:
+        """
+        Encode pack entry header: object type and its uncompressed size
+        """
+        type_num = GitObjectType[obj_type].value
+        byte = (type_num << 4) | (size & 0x0F)
+        size >>= 4
+        header = []
+
+        while size:
+            header.append(byte | 0x80)
+            byte = size & 0x7F
+            size >>= 7
+        header.append(byte)
+
+        return bytes(header)
+
+    def encode_pack_offset(self, offset: int) -> bytes:
+        """
+        Encode negative offset of the delta base,
+        in a slightly different way than sizes are encoded
+        """
+        encoded = [offset & 0x7F]
+        offset >>= 7
+
+        while offset:
+            offset -= 1
+            encoded.append(0x80 | (offset & 0x7F))
+            offset >>= 7
+
+        return bytes(reversed(encoded))
+
+    def encode_pack_object_raw(self, obj_type, obj_data) -> bytes:
+        """
+        Encode raw object data to pack format
+        """
+        header = self.encode_pack_header(obj_type, len(obj_data))
+
+        return header + self._compressor.compress(obj_data, obj_type)
+
+    def decode_pack_object_raw(self, entry: bytes) -> tuple[str, bytes]:
+        """
+        Decode object from pack format to its type and raw data.
+        For deltas, entry is expected without base offset.
+        """
+        byte = entry[0]
+        type_num = (byte >> 4) & 0x07
+        size = byte & 0x0F
+        shift = 4
+        i = 1
+
+        while byte & 0x80:
+            byte = entry[i]
+            size |= (byte & 0x7F) << shift
+            shift += 7
+            i += 1
+
+        data = zlib.decompress(entry[i:])
+        assert size == len(data), "expected size {}, got {} bytes".format(
+            size, len(data)
+        )
+
+        return (GitObjectType(type_num).name, data)
+
+    def prepare_pack_entries(
+        self, positions: Iterable[int]
+    ) -> Iterator[tuple[int, bytes, int, bytes]]:
+        """
+        Prepare stored raw objects for packing: yield position, pack entry header,
+        position of delta base (or -1) and uncompressed payload of each object.
+        Each commit becomes a delta against the previous commit in the pack.
+        """
+        previous = None
+
+        for position in positions:
+            obj_type = GitObjectType(self._types[position]).name
+            data = self._objectsdata.get(position)
+            base = -1
+            payload = data
+
+            if obj_type == GitObjectType.commit.name:
+                depth = 0
+
+                if previous and previous[2] < DELTA_MAX_DEPTH:
+                    base, base_data, depth = previous
+                    payload = self._delta.create(base_data, data)
+                    obj_type = GitObjectType.ofs_delta.name
+                    depth += 1
+
+                previous = (position, data, depth)
+
+            yield position, self.encode_pack_header(
+                obj_type, len(payload)
+            ), base, payload
+
+    def compress_pack_entries(
+        self, entries: Iterator[tuple[int, bytes, int, bytes]], count: int
+    ) -> Iterator[tuple[int, bytes, int, bytes]]:
+        """
+        Compress payloads of prepared pack entries. Big packs are compressed
+        by a thread pool in ordered batches, zlib releases the GIL while working.
+        """
+        if self._threads <= 1 or count < PACK_THREADED_MIN:
+            for position, header, base, payload in entries:
+                yield position, header, base, self.compress_payload(
+                    position, base, payload
+                )
+
+            return
+
+        with ThreadPoolExecutor(max_workers=self._threads) as pool:
+            pending = None
+
+            # next batch is prepared while the previous one is being compressed
+            while True:
+                batch = list(itertools.islice(entries, PACK_BATCH_SIZE))
+
+                if pending:
+                    yield from self.collect_batch(*pending)
+                    pending = None
+
+                if not batch:
+                    break
+
+                step = -(-len(batch) // self._threads)
+                slices = [batch[i : i + step] for i in range(0, len(batch), step)]
+                pending = (batch, pool.map(self.compress_batch, slices))
+
+    def compress_batch(self, batch: list[tuple[int, bytes, int, bytes]]) -> list[bytes]:
+        """
+        Compress payloads of a batch of prepared pack entries
+        """
+        return [
+            self.compress_payload(position, base, payload)
+            for position, _, base, payload in batch
+        ]
+
+    def compress_payload(self, position: int, base: int, payload: bytes) -> bytes:
+        """
+        Compress payload of a prepared pack entry according to its type
+        """
+        if base >= 0:
+            obj_type = GitObjectType.ofs_delta.name
+        else:
+            obj_type = GitObjectType(self._types[position]).name
+
+        return self._compressor.compress(payload, obj_type)
+
+    def collect_batch(
+        self, batch: list[tuple[int, bytes, int, bytes]], results: Iterator[list[bytes]]
+    ) -> Iterator[tuple[int, bytes, int, bytes]]:
+        """
+        Join prepared pack entries with their compressed payloads
+        """
+        compressed = itertools.chain.from_iterable(results)
+
+        for (position, header, base, _), payload in zip(batch, compressed):
+            yield position, header, base, payload
+
+    def iter_packed_entries(
+        self, positions: Iterable[int]
+    ) -> Iterator[tuple[int, bytes, int, bytes]]:
+        """
+        Same as compress_pack_entries, but takes precomputed pack entries
+        """
+        for position in positions:
+            entry = self._packeddata.get(position)
+            i = 1
+
+            while entry[i - 1] & 0x80:
+                i += 1
+
+            yield position, entry[:i], self._bases[position], entry[i:]
+
+    def iter_pack_entries(
+        self, positions: Sequence[int]
+    ) -> Iterator[tuple[bytes, bytes]]:
+        """
+        Encode objects at given positions (in ascending order) to pack format,
+        yield binary hash and pack entry of each object.
+        """
+        offset = PACK_HEADER_SIZE
+
+        # deltas are only made against the previous commit,
+        # so only its position and pack offset are kept
+        commit_position, commit_offset = -1, 0
+
+        if self._storepacked:
+            entries = self.iter_packed_entries(positions)
+        else:
+            prepared = self.prepare_pack_entries(positions)
+            entries = self.compress_pack_entries(prepared, len(positions))
+
+        for position, header, base, compressed in entries:
+            # base offset goes right after the entry header
+            if base >= 0 and base == commit_position:
+                ofs = self.encode_pack_offset(offset - commit_offset)
+                entry = header + ofs + compressed
+
+            # base is not a part of this pack
+            elif base >= 0:
+                entry = self.encode_pack_object_raw(*self.read_position(position))
+
+            else:
+                entry = header + compressed
+
+            if self._types[position] == GitObjectType.commit.value:
+                commit_position, commit_offset = position, offset
+
+            offset += len(entry)
+
+            yield self.get_digest(position), entry
+
+    def iter_pack(self, objects: Sequence[str]) -> "GitPackWriter":
+        """
+        Return a writer which yields packfile contents object by object
+        for a given set of sha hashes.
+        """
+        positions = sorted(self.lookup_object(o) for o in objects)
+
+        return GitPackWriter(self.iter_pack_entries(positions), len(positions))
+
+    def iter_pack_all(self) -> "GitPackWriter":
+        """
+        Same as iter_pack, but uses all objects in the order they were stored,
+        so that no list of hashes has to be created and sorted
+        """
+        positions = range(len(self._types))
 
-from typing import Sequence, AbstractSet
+        return GitPackWriter(self.iter_pack_entries(positions), len(positions))
 
-DEFAULT_BRANCH = "main"
-DEFAULT_COMMIT_AUTHOR = "Gitoboros"
+    def iter_pack_fast(self) -> "GitPackWriter":
+        """
+        Same as iter_pack_all, but uses precomputed pack versions
+        of objects. Requires store_packed = True to be passed
+        to the class constructor.
+        """
+        if not self._storepacked:
+            raise GitError("fast packing requires store_packed = True")
 
+        return self.iter_pack_all()
 
-class GitError(Exception):
+    def create_pack(self, objects: Sequence[str]) -> bytes:
+        """
+        Create and return bytes of the full pack file
+        containing all objects in given set of sha hashes.
+        """
+        return b"".join(self.iter_pack(objects))
+
+    def create_pack_fast(self) -> bytes:
+        """
+        Same as create_pack, but uses all objects and their
+        precomputed pack versions. Requires store_packed = True
+        to be passed to the class constructor.
+        """
+        return b"".join(self.iter_pack_fast())
+
+
+class GitPackWriter:
     """
-    Git operation error
+    Produces packfile contents chunk by chunk: header, then every
+    encoded object, then SHA-1 trailer computed on the fly.
+    Offsets and CRC32 of written objects are recorded to create pack index.
+    Reference: https://git-scm.com/docs/pack-format
     """
 
-    pass
+    def __init__(self, entries: Iterable[tuple[bytes, bytes]], count: int):
+        self._entries = entries
+        self._count = count
+        self._deltas = 0
+        self._sha1 = hashlib.sha1()
+        self._digest = None
+        self._digests = bytearray()
+        self._offsets = array.array("Q")
+        self._crcs = array.array("I")
 
+    def __iter__(self) -> Iterator[bytes]:
+        header = struct.pack("!4sLL", b"PACK", 2, self._count)
+        self._sha1.update(header)
+        offset = len(header)
 
-class PktLine:
+        yield header
+
+        for digest, entry in self._entries:
+            self._sha1.update(entry)
+            self._digests += digest
+            self._offsets.append(offset)
+            self._crcs.append(zlib.crc32(entry))
+            offset += len(entry)
+
+            if (entry[0] >> 4) & 0x07 == GitObjectType.ofs_delta.value:
+                self._deltas += 1
+
+            yield entry
+
+        self._digest = self._sha1.digest()
+
+        yield self._digest
+
+    def get_digest(self) -> bytes | None:
+        """
+        Get packfile checksum, available once all data has been written
+        """
+        return self._digest
+
+    def get_deltas(self) -> int:
+        """
+        Get number of deltified objects written so far
+        """
+        return self._deltas
+
+    def get_index(self) -> bytes:
+        """
+        Create pack index (version 2) for the written packfile
+        """
+        if self._digest is None:
+            raise GitError("pack index requires the whole packfile to be written")
+
+        order = sort_digests(self._digests)
+        view = memoryview(self._digests)
+        names = bytearray()
+        fanout = [0] * 256
+        offsets = array.array("I")
+        large_offsets = array.array("Q")
+
+        for i in order:
+            fanout[self._digests[i * 20]] += 1
+            names += view[i * 20 : i * 20 + 20]
+            offset = self._offsets[i]
+
+            # offsets which don't fit into 31 bits go to a separate table
+            if offset < 0x80000000:
+                offsets.append(offset)
+            else:
+                offsets.append(0x80000000 | len(large_offsets))
+                large_offsets.append(offset)
+
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        crcs = array.array("I", (self._crcs[i] for i in order))
+
+        # index is big-endian
+        if sys.byteorder == "little":
+            for table in (crcs, offsets, large_offsets):
+                table.byteswap()
+
+        contents = b"".join(
+            (
+                struct.pack("!4sL256L", b"\377tOc", 2, *fanout),
+                names,
+                crcs.tobytes(),
+                offsets.tobytes(),
+                large_offsets.tobytes(),
+                self._digest,
+            )
+        )
+
+        return contents + hashlib.sha1(contents).digest()
+
+
+class GitPackIndex:
     """
-    Encode/decode data according to pkt-line format.
-    Reference: https://git-scm.com/docs/protocol-common
+    Reads pack index (version 2) on top of any buffer, like bytes or mmap,
+    and finds objects by binary search without parsing the whole index.
     """
 
-    def write(self, data: bytes | str | None) -> bytes:
+    def __init__(self, data: bytes):
+        self._data = memoryview(data)
+
+        signature, version = struct.unpack_from("!4sL", self._data)
+
+        if signature != b"\377tOc":
+            raise GitError(f"invalid pack index signature {signature}")
+        if version != 2:
+            raise GitError(f"unknown pack index version {version}")
+
+        self._fanout = struct.unpack_from("!256L", self._data, 8)
+        self._count = self._fanout[255]
+        self._names = 8 + 256 * 4
+        self._crcs = self._names + 20 * self._count
+        self._offsets = self._crcs + 4 * self._count
+        self._large_offsets = self._offsets + 4 * self._count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def get_name(self, i: int) -> bytes:
         """
-        Write binary data as pkt-line
+        Get binary hash of i-th object in sorted order
         """
-        if data is None:
-            return b"0000"
+        start = self._names + 20 * i
 
-        size = len(data) + 4
-        header = f"{size:04x}".encode("ascii")
+        return bytes(self._data[start : start + 20])
 
-        if size > 0x9999:
-            raise GitError("pktline data too big")
+    def find(self, sha1: bytes | str) -> int:
+        """
+        Find object by its hash and return its number in sorted order, or -1
+        """
+        if isinstance(sha1, str):
+            sha1 = bytes.fromhex(sha1)
 
-        return header + (data.encode("ascii") if isinstance(data, str) else data)
+        first = sha1[0]
+        low = self._fanout[first - 1] if first else 0
+        high = self._fanout[first]
 
-    def parse(self, data: bytes) -> list[str]:
+        while low < high:
+            middle = (low + high) // 2
+            name = self.get_name(middle)
+
+            if name < sha1:
+                low = middle + 1
+            elif name > sha1:
+                high = middle
+            else:
+                return middle
+
+        return -1
+
+    def get_offset(self, sha1: bytes | str) -> int:
         """
-        Read a stream of pkt-line data and return a list of parsed lines
+        Get packfile offset of an object
         """
-        lines = []
-        i = 0
-        for _ in range(1000):
-            line_length = int(data[i : i + 4], 16)
-            line = data[i + 4 : i + line_length]
+        i = self.find(sha1)
 
-            # don't append flush pkts
-            if line != b"":
-                lines.append(line.decode("ascii").replace("\n", ""))
+        if i < 0:
+            raise GitError("unknown object requested")
 
-            # flush pkt
-            if line_length == 0:
-                i += 4
-            else:
-                i += line_length
+        (offset,) = struct.unpack_from("!L", self._data, self._offsets + 4 * i)
 
-            if i >= len(data):
-                break
+        if offset & 0x80000000:
+            position = self._large_offsets + 8 * (offset & 0x7FFFFFFF)
+            (offset,) = struct.unpack_from("!Q", self._data, position)
 
-        return lines
+        return offset
 
+    def get_crc32(self, sha1: bytes | str) -> int:
+        """
+        Get CRC32 of the packed object data
+        """
+        i = self.find(sha1)
 
-class GitObjectType(Enum):
-    """
-    Supported git object types
-    """
+        if i < 0:
+            raise GitError("unknown object requested")
 
-    commit = 1
-    tree = 2
-    blob = 3
+        return struct.unpack_from("!L", self._data, self._crcs + 4 * i)[0]
+
+    def get_pack_digest(self) -> bytes:
+        """
+        Get checksum of the packfile this index belongs to
+        """
+        return bytes(self._data[-40:-20])
 
 
-class GitObjectStore:
+class GitPackReader:
     """
-    Git object storage and handling
+    Reads objects from a packfile using its index. Only requested objects
+    and their delta bases are decompressed. Recently resolved objects
+    are cached, which makes walking the commit chain cheap.
     """
 
-    _storepacked = False
-    _objectsdata = {}
-    _packeddata = {}
+    def __init__(self, pack: bytes, index: GitPackIndex):
+        self._pack = memoryview(pack)
+        self._index = index
+        self._delta = GitDelta()
+        self._cache = {}
 
-    def __init__(self, store_packed=False):
-        """
-        If store_packed is True, compute packed object version on each hashing.
-        Final packfile creation will be much faster, but this will use more memory.
-        Defaults to False.
-        """
-        self._storepacked = store_packed
+        if bytes(self._pack[-20:]) != index.get_pack_digest():
+            raise GitError("pack index doesn't match the packfile")
 
-    def hash_object(self, data: bytes, obj_type: str) -> str:
+    def read_entry(self, offset: int) -> tuple[int, int, bytes]:
         """
-        Compute hash of object data of a given type and write data to the store
+        Read pack entry at given offset and return its type number,
+        offset of its delta base (or -1) and decompressed data
         """
-        header = f"{obj_type} {len(data)}".encode("ascii")
-        full_data = header + b"\x00" + data
-        sha1 = hashlib.sha1(full_data).hexdigest()
-        compressed = zlib.compress(full_data)
-        self._objectsdata[sha1] = compressed
+        byte = self._pack[offset]
+        type_num = (byte >> 4) & 0x07
+        size = byte & 0x0F
+        shift = 4
+        i = offset + 1
 
-        # compute packed version as well
-        if self._storepacked:
-            self._packeddata[sha1] = self.encode_pack_object_raw(obj_type, data)
+        while byte & 0x80:
+            byte = self._pack[i]
+            size |= (byte & 0x7F) << shift
+            shift += 7
+            i += 1
 
-        return sha1
+        base = -1
 
-    def read_object(self, sha1: str) -> tuple[str, bytes]:
+        if type_num == GitObjectType.ofs_delta.value:
+            byte = self._pack[i]
+            distance = byte & 0x7F
+            i += 1
+
+            while byte & 0x80:
+                byte = self._pack[i]
+                distance = ((distance + 1) << 7) | (byte & 0x7F)
+                i += 1
+
+            base = offset - distance
+
+        # entry size is not stored, so decompress until the end of the stream
+        decompressor = zlib.decompressobj()
+        chunks = []
+
+        while not decompressor.eof:
+            chunk = self._pack[i : i + PACK_READ_CHUNK]
+
+            if not chunk:
+                raise GitError("truncated pack entry")
+
+            chunks.append(decompressor.decompress(chunk))
+            i += len(chunk)
+
+        data = b"".join(chunks)
+
+        if size != len(data):
+            raise GitError(f"expected size {size}, got {len(data)} bytes")
+
+        return type_num, base, data
+
+    def read_at(self, offset: int) -> tuple[str, bytes]:
         """
-        Lookup object by its sha1 hash and return obj data
+        Read object at given pack offset, resolving deltas
         """
-        if sha1 not in self._objectsdata:
-            raise GitError("unknown object requested")
+        if len(self._cache) > PACK_READ_CACHE:
+            self._cache.clear()
 
-        full_data = zlib.decompress(self._objectsdata[sha1])
-        nul_index = full_data.index(b"\x00")
-        header = full_data[:nul_index]
-        obj_type, size_str = header.decode().split()
-        size = int(size_str)
-        data = full_data[nul_index + 1 :]
-        assert size == len(data), "expected size {}, got {} bytes".format(
-            size, len(data)
-        )
+        deltas = []
+
+        # go down the delta chain until a cached or a full object is found
+        while offset not in self._cache:
+            type_num, base, data = self.read_entry(offset)
+
+            if base < 0:
+                self._cache[offset] = (GitObjectType(type_num).name, data)
+                break
+
+            deltas.append((offset, data))
+            offset = base
+
+        obj_type, data = self._cache[offset]
+
+        for offset, delta in reversed(deltas):
+            data = self._delta.apply(data, delta)
+            self._cache[offset] = (obj_type, data)
 
         return (obj_type, data)
 
-    def encode_pack_object_raw(self, obj_type, obj_data) -> bytes:
+    def read_object(self, sha1: bytes | str) -> tuple[str, bytes]:
         """
-        Encode raw object data to pack format
+        Lookup object by its hash and return its type and data
         """
-        type_num = GitObjectType[obj_type].value
-        size = len(obj_data)
-        byte = (type_num << 4) | (size & 0x0F)
-        size >>= 4
-        header = []
-
-        while size:
-            header.append(byte | 0x80)
-            byte = size & 0x7F
-            size >>= 7
-        header.append(byte)
+        return self.read_at(self._index.get_offset(sha1))
 
-        return bytes(header) + zlib.compress(obj_data)
+    def has_object(self, sha1: bytes | str) -> bool:
+        """
+        Check whether packfile contains an object with a given hash
+        """
+        return self._index.find(sha1) >= 0
 
-    def encode_pack_object(self, sha1: str) -> bytes:
+    def read_commit(self, sha1: str) -> tuple[str, list[str], int]:
         """
-        Lookup an object and encode it to pack format
+        Return tree, parents and commit time of a commit
         """
         obj_type, data = self.read_object(sha1)
 
-        return self.encode_pack_object_raw(obj_type, data)
+        if obj_type != GitObjectType.commit.name:
+            raise GitError(f"{sha1} is not a commit")
 
-    def create_pack(self, objects: Sequence[str]) -> bytes:
+        tree = None
+        parents = []
+        timestamp = 0
+
+        for line in data[: data.index(b"\n\n")].split(b"\n"):
+            if line[:5] == b"tree ":
+                tree = line[5:].decode("ascii")
+            elif line[:7] == b"parent ":
+                parents.append(line[7:].decode("ascii"))
+            elif line[:10] == b"committer ":
+                timestamp = int(line.rsplit(b" ", 2)[1])
+
+        return tree, parents, timestamp
+
+    def iter_tree(self, sha1: str) -> Iterator[tuple[int, str]]:
         """
-        Create and return bytes of the full pack file
-        containing all objects in given set of sha hashes.
+        Iterate over modes and hashes of tree entries
         """
-        header = struct.pack("!4sLL", b"PACK", 2, len(objects))
-        body = b"".join(self.encode_pack_object(o) for o in sorted(objects))
-        contents = header + body
-        sha1 = hashlib.sha1(contents).digest()
-        data = contents + sha1
+        _, data = self.read_object(sha1)
+        i = 0
 
-        return data
+        while i < len(data):
+            space = data.index(b" ", i)
+            nul = data.index(b"\x00", space)
 
-    def create_pack_fast(self) -> bytes:
+            yield int(data[i:space], 8), data[nul + 1 : nul + 21].hex()
+            i = nul + 21
+
+    def walk_tree(self, sha1: str, seen: set[str]) -> list[str]:
         """
-        Same as create_pack, but uses all objects and their
-        precomputed pack versions. Requires store_packed = True
-        to be passed to the class constructor.
+        Return a tree and all trees and blobs it refers to,
+        except already seen ones. Seen objects are updated.
         """
-        if not self._storepacked:
-            raise GitError("create_pack_fast requires store_packed = True")
+        trees = [sha1]
+        objects = []
+        seen.add(sha1)
+
+        while trees:
+            tree = trees.pop()
+            objects.append(tree)
+
+            for mode, entry in self.iter_tree(tree):
+                if entry in seen:
+                    continue
+
+                seen.add(entry)
+
+                # subtrees are walked next, blobs are just listed
+                if mode == 0o40000:
+                    trees.append(entry)
+                else:
+                    objects.append(entry)
+
+        return objects
+
+    def find_missing(
+        self,
+        wants: Iterable[str],
+        haves: Iterable[str],
+        shallow: AbstractSet[str] = frozenset(),
+        depth: int | None = None,
+        since: int | None = None,
+        relative: bool = False,
+    ) -> tuple[list[str], list[str], list[str]]:
+        """
+        Find objects reachable from wanted commits, but not from the ones a client
+        already has. Commits are returned first, from the oldest to the newest,
+        followed by trees and blobs. History is walked back from wanted commits
+        up to the first common one, so all of it is sent for unrelated haves.
+
+        If depth (number of commits) or since (commit time) is given, history is
+        cut accordingly; it's walked past common commits then, since a shallow
+        client lacks history behind its shallow commits. New shallow commits and
+        client shallow commits which got their parents are also returned.
+        Relative depth is counted from client shallow commits instead.
+        """
+        common = {sha1 for sha1 in haves if self.has_object(sha1)}
+        deepen = depth is not None or since is not None
+        seen = set()
+        visited = set()
+        commits = []
+        boundary = []
+        unshallow = []
+
+        # objects of common commits are present on the client
+        for sha1 in common:
+            obj_type, _ = self.read_object(sha1)
+
+            if obj_type == GitObjectType.commit.name:
+                tree, _, _ = self.read_commit(sha1)
+                self.walk_tree(tree, seen)
+            else:
+                seen.add(sha1)
+
+        # commit, its distance from the wanted one (or a shallow one, if depth
+        # is relative), whether client has it and the commit it was reached from
+        pending = [(sha1, 0 if relative else 1, False, None) for sha1 in wants]
+
+        while pending:
+            sha1, level, present, child = pending.pop()
+
+            if sha1 in visited:
+                continue
+
+            visited.add(sha1)
+            present = present or sha1 in common
+            tree, parents, timestamp = self.read_commit(sha1)
+
+            if present and not deepen:
+                continue
+
+            # commit is too old, so the one it was reached from becomes shallow
+            if since is not None and timestamp < since and child is not None:
+                boundary.append(child)
+                continue
+
+            if not present:
+                commits.append(sha1)
+
+            if depth is not None and level >= depth > 0:
+                if parents:
+                    boundary.append(sha1)
+
+                continue
 
-        obj_keys = self._packeddata.keys()
-        header = struct.pack("!4sLL", b"PACK", 2, len(obj_keys))
-        body = b"".join(self._packeddata[o] for o in sorted(obj_keys))
-        contents = header + body
-        sha1 = hashlib.sha1(contents).digest()
-        data = contents + sha1
+            if sha1 in shallow and parents:
+                unshallow.append(sha1)
 
-        return data
+            # history behind client shallow commits is missing on the client
+            if level or not relative or sha1 in shallow:
+                level += 1
+
+            present = present and sha1 not in shallow
+            pending.extend((p, level, present, sha1) for p in parents)
+
+        commits.reverse()
+        objects = []
+
+        for sha1 in commits:
+            tree, _, _ = self.read_commit(sha1)
+
+            if tree not in seen:
+                objects.extend(self.walk_tree(tree, seen))
+
+        # client shallow commit may remain shallow if its parents are too old
+        shallow_commits = [sha1 for sha1 in boundary if sha1 not in shallow]
+        unshallow = [sha1 for sha1 in unshallow if sha1 not in boundary]
+
+        return commits + objects, shallow_commits, unshallow
+
+    def iter_pack(
+        self,
+        objects: Sequence[str],
+        threads: int = 1,
+        compressor: GitCompressor | None = None,
+    ) -> "GitPackWriter":
+        """
+        Return a writer for a new packfile with given objects of this one.
+        Commits are deltified again against each other in the given order.
+        Threads and compressor are passed to the object store which packs them.
+        """
+        store = GitObjectStore(threads=threads, compressor=compressor)
+
+        for sha1 in objects:
+            obj_type, data = self.read_object(sha1)
+            store.hash_object(data, obj_type)
+
+        return store.iter_pack(objects)
 
 
 # data for one entry in the git index (.git/index)
@@ -229,19 +1624,120 @@ GitIndexEntry = namedtuple(
 
 class GitIndex:
     """
-    Index storage and handler
+    Index storage and handler. Entries are kept in memory sorted by path,
+    only in their packed form, and unpacked when read. Serialized index
+    (DIRC version 2) is produced only when requested and cached until
+    the next change.
     """
 
-    _indexdata = b""
+    def __init__(self):
+        self._paths = []
+        self._packed = []
+        self._indexdata = None
+
+    def __len__(self) -> int:
+        return len(self._packed)
+
+    def __iter__(self) -> Iterator[GitIndexEntry]:
+        return map(self.unpack_entry, self._packed)
+
+    def pack_entry(self, entry: GitIndexEntry) -> bytes:
+        """
+        Pack single index entry, padded with NULs to a multiple of 8 bytes
+        """
+        entry_head = struct.pack(
+            INDEX_ENTRY_FORMAT,
+            entry.ctime_s,
+            entry.ctime_n,
+            entry.mtime_s,
+            entry.mtime_n,
+            entry.dev,
+            entry.ino,
+            entry.mode,
+            entry.uid,
+            entry.gid,
+            entry.size,
+            entry.sha1,
+            entry.flags,
+        )
+        path = entry.path.encode()
+        length = ((62 + len(path) + 8) // 8) * 8
+
+        return entry_head + path + b"\x00" * (length - 62 - len(path))
+
+    def unpack_entry(self, packed: bytes) -> GitIndexEntry:
+        """
+        Unpack single index entry, path is terminated by padding NULs
+        """
+        fields = struct.unpack_from(INDEX_ENTRY_FORMAT, packed)
+        path = packed[62 : packed.index(b"\x00", 62)].decode()
+
+        return GitIndexEntry(*fields, path)
+
+    def add(self, entry: GitIndexEntry):
+        """
+        Add an entry to the index, replacing an entry with the same path
+        """
+        i = bisect.bisect_left(self._paths, entry.path)
+        packed = self.pack_entry(entry)
+
+        if i < len(self._paths) and self._paths[i] == entry.path:
+            self._packed[i] = packed
+        else:
+            self._paths.insert(i, entry.path)
+            self._packed.insert(i, packed)
+
+        self._indexdata = None
+
+    def iter_prefix(self, prefix: str) -> Iterator[GitIndexEntry]:
+        """
+        Iterate over entries which paths start with given prefix
+        """
+        i = bisect.bisect_left(self._paths, prefix)
+
+        while i < len(self._paths) and self._paths[i].startswith(prefix):
+            yield self.unpack_entry(self._packed[i])
+            i += 1
 
     def read(self) -> list[GitIndexEntry]:
         """
         Read index data
         """
-        if len(self._indexdata) == 0:
-            return []
+        return list(self)
+
+    def write(self, entries: Sequence[GitIndexEntry]):
+        """
+        Write index data
+        """
+        self.write_packed([(entry.path, self.pack_entry(entry)) for entry in entries])
+
+    def write_packed(self, entries: list[tuple[str, bytes]]):
+        """
+        Write index data from paths and packed entries
+        """
+        entries.sort(key=operator.itemgetter(0))
+
+        self._paths = [path for path, _ in entries]
+        self._packed = [packed for _, packed in entries]
+        self._indexdata = None
+
+    def serialize(self) -> bytes:
+        """
+        Return index contents in git format
+        """
+        if self._indexdata is None:
+            header = struct.pack("!4sLL", b"DIRC", 2, len(self._packed))
+            all_data = header + b"".join(self._packed)
+            digest = hashlib.sha1(all_data).digest()
+            self._indexdata = all_data + digest
+
+        return self._indexdata
 
-        data = self._indexdata
+    def parse(self, data: bytes):
+        """
+        Replace index entries with the ones from index contents in git format.
+        Entries are stored as they are, without unpacking
+        """
         digest = hashlib.sha1(data[:-20]).digest()
 
         if digest != data[-20:]:
@@ -260,49 +1756,16 @@ class GitIndex:
 
         while i + 62 < len(entry_data):
             fields_end = i + 62
-            fields = struct.unpack("!LLLLLLLLLL20sH", entry_data[i:fields_end])
             path_end = entry_data.index(b"\x00", fields_end)
             path = entry_data[fields_end:path_end]
-            entry = GitIndexEntry(*(fields + (path.decode(),)))
-            entries.append(entry)
             entry_len = ((62 + len(path) + 8) // 8) * 8
+            entries.append((path.decode(), entry_data[i : i + entry_len]))
             i += entry_len
 
         assert len(entries) == num_entries
 
-        return entries
-
-    def write(self, entries: Sequence[GitIndexEntry]):
-        """
-        Write index data
-        """
-        packed_entries = []
-
-        for entry in entries:
-            entry_head = struct.pack(
-                "!LLLLLLLLLL20sH",
-                entry.ctime_s,
-                entry.ctime_n,
-                entry.mtime_s,
-                entry.mtime_n,
-                entry.dev,
-                entry.ino,
-                entry.mode,
-                entry.uid,
-                entry.gid,
-                entry.size,
-                entry.sha1,
-                entry.flags,
-            )
-            path = entry.path.encode()
-            length = ((62 + len(path) + 8) // 8) * 8
-            packed_entry = entry_head + path + b"\x00" * (length - 62 - len(path))
-            packed_entries.append(packed_entry)
-
-        header = struct.pack("!4sLL", b"DIRC", 2, len(entries))
-        all_data = header + b"".join(packed_entries)
-        digest = hashlib.sha1(all_data).digest()
-        self._indexdata = all_data + digest
+        self.write_packed(entries)
+        self._indexdata = data
 
 
 class GitRepo:
@@ -316,10 +1779,29 @@ class GitRepo:
     _index = None
     _branch = None
 
-    def __init__(self, default_branch="main"):
+    # hashes of written trees by directory, "" is the top-level one
+    _trees = None
+
+    def __init__(
+        self,
+        default_branch="main",
+        store_packed=False,
+        threads=1,
+        compressor=None,
+        seed=None,
+        spill_threshold=None,
+    ):
+        """
+        If seed is provided, all generated metadata is derived from it,
+        so the same sequence of operations produces identical objects
+        """
+        self._random = random.Random(seed)
         self._index = GitIndex()
-        self._objects = GitObjectStore()
+        self._objects = GitObjectStore(
+            store_packed, threads, compressor, spill_threshold
+        )
         self._branch = default_branch
+        self._trees = {}
 
     def get_branch(self) -> str:
         """
@@ -337,35 +1819,102 @@ class GitRepo:
         """
         Retrieve all objects in this repo
         """
-        return set(self._objects._objectsdata.keys())
+        return self._objects.get_objects()
 
     def create_packfile(self, objects: Sequence[str]) -> bytes:
         return self._objects.create_pack(objects)
 
-    def write_tree(self) -> str:
+    def iter_packfile(self, objects: Sequence[str]) -> GitPackWriter:
+        """
+        Create packfile writer for given objects. Once the packfile
+        has been written, its index can be obtained from the writer.
+        """
+        return self._objects.iter_pack(objects)
+
+    def iter_packfile_all(self) -> GitPackWriter:
+        """
+        Same as iter_packfile, but for all objects of the repo
+        """
+        return self._objects.iter_pack_all()
+
+    def get_count(self) -> int:
+        """
+        Get number of objects in this repo
+        """
+        return len(self._objects)
+
+    def seal(self):
+        """
+        Compact object lookup structures once no more objects will be added
+        """
+        self._objects.seal()
+
+    def get_size(self) -> int:
+        """
+        Get approximate memory footprint of the repo objects in bytes
+        """
+        return self._objects.get_size()
+
+    def get_spilled_size(self) -> int:
+        """
+        Get number of bytes of repo objects moved to disk
+        """
+        return self._objects.get_spilled_size()
+
+    def release(self):
+        """
+        Free all objects held by this repo. Once the packfile
+        has been created, they are not needed anymore.
+        """
+        self._objects.release()
+
+    def write_tree(self, directory: str = "") -> str:
         """
-        Write repository tree from the current index entries and return its hash
+        Write repository tree (or a tree of given directory) from the current
+        index entries and return its hash. Subtree hashes are cached, so only
+        directories changed since the previous call are written again.
         """
+        cached = self._trees.get(directory)
+
+        if cached is not None:
+            return cached
+
+        prefix = directory + "/" if directory else ""
         tree_entries = []
+        subtree = None
+
+        # index is sorted by full path, which gives the same order as git
+        # uses for trees, where directory names are compared with trailing "/"
+        for entry in self._index.iter_prefix(prefix):
+            name = entry.path[len(prefix) :]
 
-        for entry in self._index.read():
-            assert (
-                "/" not in entry.path
-            ), "currently only supports a single, top-level directory"
-            mode_path = "{:o} {}".format(entry.mode, entry.path).encode()
-            tree_entry = mode_path + b"\x00" + entry.sha1
-            tree_entries.append(tree_entry)
+            if "/" in name:
+                name = name[: name.index("/")]
 
-        return self._objects.hash_object(b"".join(tree_entries), "tree")
+                if name == subtree:
+                    continue
+
+                subtree = name
+                sha1 = bytes.fromhex(self.write_tree(prefix + name))
+                mode_path = "40000 {}".format(name).encode()
+            else:
+                sha1 = entry.sha1
+                mode_path = "{:o} {}".format(entry.mode, name).encode()
+
+            tree_entries.append(mode_path + b"\x00" + sha1)
+
+        tree = self._objects.hash_object(b"".join(tree_entries), "tree")
+        self._trees[directory] = tree
+
+        return tree
 
     def add_binary(self, path: str, data: bytes, timestamp: int | None = None):
         """
-        Add a file (blob) to the repo, only same directory is supported
+        Add a file (blob) to the repo, path may include directories
         """
         if timestamp is None:
             timestamp = int(time.time())
 
-        entries = self._index.read()
         sha1 = self._objects.hash_object(data, "blob")
         flags = len(path.encode("utf-8"))
         assert flags < (1 << 12)
@@ -381,7 +1930,7 @@ class GitRepo:
         # be used here, but noone likes a file committed by root. Right?
         mode = 33188
         uidgid = 1000
-        st_ino = random.randrange(0, 2**32 - 1)
+        st_ino = self._random.randrange(0, 2**32 - 1)
         st_dev = 16777221
         entry = GitIndexEntry(
             timestamp,
@@ -398,9 +1947,14 @@ class GitRepo:
             flags,
             path,
         )
-        entries.append(entry)
-        entries.sort(key=operator.attrgetter("path"))
-        self._index.write(entries)
+        self._index.add(entry)
+
+        # trees of all parent directories have to be written again
+        directory = path
+
+        while directory:
+            directory = directory.rpartition("/")[0]
+            self._trees.pop(directory, None)
 
     def do_commit(
         self, author: str, email: str, message: str, timestamp: int | None = None
@@ -430,3 +1984,45 @@ class GitRepo:
         self._current = sha1
 
         return sha1
+
+    def do_commits(
+        self,
+        author: str,
+        email: str,
+        message: str,
+        timestamps: Iterable[int],
+    ) -> str:
+        """
+        Create a chain of commits, one per given UNIX timestamp, and return hash
+        of the last one. Message is a format string which receives commit number.
+        Produces exactly the same commits as calling do_commit for each timestamp.
+        """
+        identity = f"{author} <{email}>".encode("utf-8")
+        tree = b"tree " + self.write_tree().encode("ascii") + b"\n"
+        author_line = b"author " + identity + b" "
+        committer_line = b" +0000\ncommitter " + identity + b" "
+        message_line = b" +0000\n\n"
+        hash_object = self._objects.hash_object
+        parent = self._current
+
+        for i, timestamp in enumerate(timestamps):
+            stamp = b"%d" % timestamp
+            parent_line = b"parent %s\n" % parent.encode("ascii") if parent else b""
+            data = b"".join(
+                (
+                    tree,
+                    parent_line,
+                    author_line,
+                    stamp,
+                    committer_line,
+                    stamp,
+                    message_line,
+                    message.format(i).encode("utf-8"),
+                    b"\n",
+                )
+            )
+            parent = hash_object(data, "commit")
+
+        self._current = parent
+
+        return parent
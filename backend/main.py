@@ -5,20 +5,29 @@ import logging.config
 
 import uvicorn
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from starlette_context import plugins
 from starlette_context.middleware import RawContextMiddleware
 
 from api import MainAPIRouter
-from smart_proto import GitRouter
+from smart_proto import GitRouter, GitClientApp
 from session import SessionLifespan
+from export import ExportLifespan
 
 from utils import GitoborosException, gitoboros_exception_handler
 from logconfig import get_generic_logging_config, get_uvicorn_logging_config
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with SessionLifespan(app), ExportLifespan(app):
+        yield
+
+
 # create app
-app = FastAPI(lifespan=SessionLifespan)
+app = FastAPI(lifespan=lifespan)
 
 # setup CORS; wildcard here since proper
 # filtering will be done by nginx proxy
@@ -39,6 +48,13 @@ app.add_exception_handler(GitoborosException, gitoboros_exception_handler)
 app.include_router(MainAPIRouter)
 app.include_router(GitRouter)
 
+# git clients are served by a lean ASGI app in front of the main one,
+# bypassing its routing and middlewares; GitRouter handles them otherwise
+if os.environ.get("GIT_FAST_PATH", "1") == "1":
+    server_app = GitClientApp(app)
+else:
+    server_app = app
+
 
 async def main_init():
     port = int(os.environ.get("HTTP_PORT", 8000))
@@ -50,7 +66,7 @@ async def main_init():
 
     # https://www.uvicorn.org/#config-and-server-instances
     config = uvicorn.Config(
-        app=app,
+        app=server_app,
         port=port,
         host=host,
         workers=workers,
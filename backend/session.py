@@ -4,13 +4,15 @@ Redis session management
 
 import os
 import uuid
+import asyncio
 import base58
+import array
 import base64
 import hashlib
 import logging
 
 from enum import Enum
-from typing import Optional
+from typing import Optional, Iterable
 from dataclasses import dataclass
 from contextlib import asynccontextmanager
 
@@ -34,6 +36,17 @@ SESSION_EXPIRY_TIME = 60 * 5
 # before its actual expiration.
 SESSION_EXPIRY_SAFEGUARD = 3
 
+# packfiles are stored by their checksum and shared between sessions,
+# so that a recreated session with the same input could reuse the
+# previously built packfile; they take most of Redis memory, so by
+# default they don't outlive sessions for long
+PACK_EXPIRY_TIME = int(os.environ.get("PACK_EXPIRY_TIME", SESSION_EXPIRY_TIME))
+
+# packfile is appended to Redis in base64-encoded pieces
+# of this size; it must be a multiple of 3, so that pieces
+# can be encoded independently and concatenated afterwards
+PACKFILE_WRITE_CHUNK = 3 * 2**18
+
 # when parallel session has been already opened,
 # wait AT MOST this time in seconds for
 # its completion
@@ -41,6 +54,10 @@ SESSION_WAIT_TIMEOUT = 10
 
 logger = logging.getLogger(__name__)
 
+# packfiles being loaded from Redis by their keys; concurrent
+# requests for the same packfile wait for a single load
+PACK_LOADS: dict[str, asyncio.Future] = {}
+
 
 class SessionState(Enum):
     """
@@ -61,7 +78,19 @@ class SessionData:
 
     total_objects: int
     latest_object: str
-    packfile: bytes
+
+    # number of objects stored as deltas in the packfile
+    total_deltas: int = 0
+
+    # packfile is stored under its own key and may be written separately;
+    # loaded one is a read-only view, shared by concurrent requests
+    packfile: Optional[bytes | memoryview] = None
+
+    # hex checksum of the packfile, which is also its storage key
+    pack_digest: Optional[str] = None
+
+    # packfile may be stored already split into side-band-64k frames
+    framed: bool = False
 
     # state will be explicitly managed separately,
     # and branch value is not mandatory (defaults to "main")
@@ -69,6 +98,18 @@ class SessionData:
     branch: Optional[str] = None
 
 
+# session hash fields which are read without the packfile
+SESSION_METADATA_FIELDS = [
+    "total_objects",
+    "total_deltas",
+    "latest_object",
+    "pack_digest",
+    "framed",
+    "state",
+    "branch",
+]
+
+
 class SessionError(Exception):
     pass
 
@@ -96,6 +137,43 @@ class Session:
         """
         return str(self.identifier)
 
+    def get_packfile_id(self) -> str:
+        """
+        Get key under which packfile of this session is being written
+        """
+        return f"{self.get_id()}:packfile"
+
+    def get_pack_id(self, digest: str, framed: bool = False) -> str:
+        """
+        Get key under which packfile with a given checksum is stored.
+        Framed packfiles are stored separately from plain ones.
+        """
+        return f"pack:{digest}:framed" if framed else f"pack:{digest}"
+
+    def get_index_id(self, digest: str) -> str:
+        """
+        Get key under which index of a packfile with a given checksum is stored
+        """
+        return f"pack:{digest}:index"
+
+    def get_build_id(self, build_key: str) -> str:
+        """
+        Get key under which result of a build with a given input is stored
+        """
+        return f"build:{build_key}"
+
+    def make_build_key(self, contribs: Iterable[int], *params) -> str:
+        """
+        Create build key from session ID, contributions and any extra
+        build parameters. Reproducible builds with equal keys produce
+        identical packfiles.
+        """
+        key = hashlib.blake2b(self.identifier.bytes)
+        key.update(repr(params).encode("ascii"))
+        key.update(array.array("q", contribs).tobytes())
+
+        return key.hexdigest()
+
     async def make_from_data(self, handle: str, email: str, branch: str):
         """
         Create deterministic session ID based on combination of
@@ -151,13 +229,25 @@ class Session:
         """
         Checks whether session already exists and is valid (closed)
         """
-        state = await self.redis.hget(self.get_id(), "state")
+        # both values are requested in a single round trip
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hget(self.get_id(), "state")
+            pipe.ttl(self.get_id())
+
+            state, ttl = await pipe.execute()
+
+        return self.check_state(state, ttl)
+
+    @staticmethod
+    def check_state(state: str | None, ttl: int) -> bool:
+        """
+        Checks whether session with given state and TTL is valid
+        """
         is_closed = state == SessionState.closed.value
         about_to_expire = False
 
         # determine if the session is about to expire. if it is, better
         # to mark it as invalid so it would be safely recreated and extended.
-        ttl = await self.redis.ttl(self.get_id())
         ttl = int(ttl)
 
         if ttl != -1:
@@ -171,37 +261,234 @@ class Session:
         """
         await self.redis.expire(self.get_id(), SESSION_EXPIRY_TIME)
 
+        # shared packfile must live at least as long as the session
+        digest, framed = await self.redis.hmget(
+            self.get_id(), ["pack_digest", "framed"]
+        )
+
+        if digest is not None:
+            pack_id = self.get_pack_id(digest, framed == "1")
+
+            await self.redis.expire(pack_id, PACK_EXPIRY_TIME)
+            await self.redis.expire(self.get_index_id(digest), PACK_EXPIRY_TIME)
+
+    async def set_packfile(self, chunks: Iterable[bytes]):
+        """
+        Write packfile for this session, consuming it chunk by chunk.
+        Only a small buffer is kept in memory at any time. Once written,
+        packfile has to be stored by its checksum with store_pack.
+        """
+        key = self.get_packfile_id()
+        buffer = bytearray()
+
+        # since decode_responses is passed to Redis, it will
+        # try to decode packfile upon accessing session data
+        # and will fail, so resort to base64. Another (faster)
+        # option is to pass decode_responses = False and
+        # store bytes directly, but it will require casting
+        # all other strings from bytes and vice versa.
+        await self.redis.delete(key)
+
+        for chunk in chunks:
+            buffer += chunk
+
+            if len(buffer) >= PACKFILE_WRITE_CHUNK:
+                size = len(buffer) - len(buffer) % 3
+
+                await self.redis.append(key, base64.b64encode(buffer[:size]))
+                del buffer[:size]
+
+        await self.redis.append(key, base64.b64encode(buffer))
+
+        # don't leave packfile behind if session won't be finalized
+        await self.redis.expire(key, SESSION_EXPIRY_TIME)
+
+    async def store_pack(
+        self, digest: str, index: Optional[bytes] = None, framed: bool = False
+    ):
+        """
+        Move written packfile under its checksum, along with its index.
+        Packfile with the same checksum is identical, so it's safe to replace.
+        """
+        pack_id = self.get_pack_id(digest, framed)
+
+        await self.redis.rename(self.get_packfile_id(), pack_id)
+        await self.redis.expire(pack_id, PACK_EXPIRY_TIME)
+
+        if index is not None:
+            await self.redis.set(
+                self.get_index_id(digest), base64.b64encode(index), ex=PACK_EXPIRY_TIME
+            )
+
+    async def get_index(self) -> bytes:
+        """
+        Retrieve index of the session packfile
+        """
+        digest = await self.redis.hget(self.get_id(), "pack_digest")
+        index = None
+
+        if digest is not None:
+            index = await self.redis.get(self.get_index_id(digest))
+
+        if index is None:
+            raise SessionError("no packfile index stored")
+
+        return base64.b64decode(index)
+
+    async def set_build(self, build_key: str, data: SessionData):
+        """
+        Remember build result, so that the same input could reuse it
+        """
+        key = self.get_build_id(build_key)
+
+        await self.redis.hset(
+            key,
+            mapping={
+                "total_objects": str(data.total_objects),
+                "total_deltas": str(data.total_deltas),
+                "latest_object": data.latest_object,
+                "pack_digest": data.pack_digest,
+                "framed": "1" if data.framed else "0",
+            },
+        )
+        await self.redis.expire(key, PACK_EXPIRY_TIME)
+
+    async def find_build(self, build_key: str) -> Optional[SessionData]:
+        """
+        Look up result of a previous build with the same input.
+        Returns None if there's none or its packfile has already expired.
+        """
+        key = self.get_build_id(build_key)
+        build = await self.redis.hgetall(key)
+
+        if not build:
+            return None
+
+        digest = build["pack_digest"]
+        framed = build["framed"] == "1"
+
+        # refresh packfile first, so it won't expire between the calls
+        pack_id = self.get_pack_id(digest, framed)
+
+        if not await self.redis.expire(pack_id, PACK_EXPIRY_TIME):
+            return None
+
+        await self.redis.expire(self.get_index_id(digest), PACK_EXPIRY_TIME)
+        await self.redis.expire(key, PACK_EXPIRY_TIME)
+
+        return SessionData(
+            total_objects=int(build["total_objects"]),
+            total_deltas=int(build["total_deltas"]),
+            latest_object=build["latest_object"],
+            pack_digest=digest,
+            framed=framed,
+        )
+
     async def set_data(self, data: SessionData):
         """
         Store data for this session as a Redis hash object
         """
+        pack_digest = data.pack_digest
+
+        if data.packfile is not None:
+            # packfile checksum is stored in its trailer
+            pack_digest = data.packfile[-20:].hex()
+
+            await self.set_packfile([data.packfile])
+            await self.store_pack(pack_digest, framed=data.framed)
+
         await self.redis.hset(
             self.get_id(),
             mapping={
                 "total_objects": str(data.total_objects),
+                "total_deltas": str(data.total_deltas),
                 "latest_object": data.latest_object,
-                # since decode_responses is passed to Redis, it will
-                # try to decode packfile upon accessing session data
-                # and will fail, so resort to this. Another (faster)
-                # option is to pass decode_responses = False and
-                # store bytes directly, but it will require casting
-                # all other strings from bytes and vice versa.
-                "packfile": base64.b64encode(data.packfile),
+                "pack_digest": pack_digest,
+                "framed": "1" if data.framed else "0",
             },
         )
 
-    async def get_data(self):
+    async def get_metadata(self) -> SessionData:
         """
-        Retrieve previously stored session data
+        Retrieve session data without the packfile, which is much cheaper
         """
-        data = await self.redis.hgetall(self.get_id())
+        values = await self.redis.hmget(self.get_id(), SESSION_METADATA_FIELDS)
+
+        return self.parse_metadata(dict(zip(SESSION_METADATA_FIELDS, values)))
+
+    async def get_valid_metadata(self) -> SessionData | None:
+        """
+        Same as get_metadata, but also checks whether session is valid
+        in the same round trip; None is returned for invalid session
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(self.get_id(), SESSION_METADATA_FIELDS)
+            pipe.ttl(self.get_id())
+
+            values, ttl = await pipe.execute()
+
+        data = dict(zip(SESSION_METADATA_FIELDS, values))
+
+        if not self.check_state(data["state"], ttl):
+            return None
+
+        return self.parse_metadata(data)
+
+    def parse_metadata(self, data: dict[str, str | None]) -> SessionData:
+        """
+        Create session data from SESSION_METADATA_FIELDS values
+        """
+        if data["latest_object"] is None:
+            raise SessionError("no session data stored")
 
         return SessionData(
             total_objects=int(data["total_objects"]),
+            total_deltas=int(data["total_deltas"]),
             latest_object=data["latest_object"],
-            packfile=base64.b64decode(data["packfile"]),
+            pack_digest=data["pack_digest"],
+            framed=data["framed"] == "1",
+            state=data["state"],
+            branch=data["branch"],
         )
 
+    async def get_data(self) -> SessionData:
+        """
+        Retrieve previously stored session data
+        """
+        data = await self.get_metadata()
+        data.packfile = await self.get_packfile(data.pack_digest, data.framed)
+
+        return data
+
+    async def get_packfile(self, digest: str, framed: bool = False) -> memoryview:
+        """
+        Retrieve packfile with a given checksum as a read-only view.
+        If it's already being loaded, e.g. when many clients clone
+        the same repo at once, wait for that load and share its result.
+        """
+        pack_id = self.get_pack_id(digest, framed)
+        load = PACK_LOADS.get(pack_id)
+
+        if load is None:
+            load = asyncio.ensure_future(self.load_packfile(pack_id))
+            load.add_done_callback(lambda _: PACK_LOADS.pop(pack_id, None))
+
+            PACK_LOADS[pack_id] = load
+
+        # one of the waiters being cancelled should not affect the others
+        return await asyncio.shield(load)
+
+    async def load_packfile(self, pack_id: str) -> memoryview:
+        """
+        Load and decode packfile stored under a given key
+        """
+        packfile = await self.redis.get(pack_id)
+
+        if packfile is None:
+            raise SessionError("packfile has expired")
+
+        return memoryview(base64.b64decode(packfile)).toreadonly()
+
     def create_logger(self, logger: logging.Logger):
         """
         Create session-specific logger instance
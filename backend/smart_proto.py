@@ -22,22 +22,68 @@ bytes in OCTAL encoding (wtf), and everything else in plain ASCII. So stuff can
 and here "Counting objects" string is prefixed by 0x02 and terminated with 0x0d (CR, \r)
 """
 
+import os
+import zlib
 import asyncio
 import logging
+import functools
 
 from enum import Enum
-from typing import Callable
+from string import hexdigits
+from typing import Callable, Coroutine, Iterator, AsyncIterator
 
 from fastapi import APIRouter, Request, Response, HTTPException, Depends
 from fastapi.routing import APIRoute
 from fastapi.responses import StreamingResponse
-
-from git import PktLine, GitError
-from session import SessionStore, SessionData
-from utils import verify_repo_id
+from starlette.requests import ClientDisconnect
+from starlette_context import plugins
+from starlette_context.middleware import RawContextMiddleware
+
+from git import (
+    PktLine,
+    PktLineReader,
+    PktLineType,
+    GitPackIndex,
+    GitPackReader,
+    GitCompressor,
+    GitError,
+    PKTLINE_MAX_SIZE,
+)
+from session import Session, SessionStore, SessionData, SESSION_ID_LENGTH
+from utils import verify_repo_id, get_repo_metadata
 
 logger = logging.getLogger(__name__)
 
+# maximum size of response data buffered for a single client, in bytes;
+# producer waits until the client reads some of it before adding more
+STREAM_BUFFER_SIZE = 16 * PKTLINE_MAX_SIZE
+
+# send packfile right away, without typing out the banner and emulating object
+# counting, which otherwise keeps every clone connection busy for a few seconds
+CLONE_FAST_PATH = os.environ.get("CLONE_FAST_PATH", "1") == "1"
+
+# git clients are served under this path
+GIT_PREFIX = "/repo"
+
+# number of threads used to compress big packfiles
+PACK_THREADS = int(os.environ.get("PACK_THREADS", os.cpu_count() or 1))
+
+# zlib levels by object type, e.g. "commit=1,ofs_delta=6"; used both
+# for full packfiles of new repos and partial ones made for fetches
+PACK_COMPRESSION = GitCompressor(
+    {
+        obj_type.strip(): int(level)
+        for obj_type, level in (
+            pair.split("=")
+            for pair in os.environ.get("PACK_COMPRESSION", "").split(",")
+            if pair
+        )
+    }
+)
+
+# number of cached refs advertisements, which are tiny and differ by head only
+ADVERTISEMENT_CACHE_SIZE = 4096
+
 
 class StreamStop(Enum):
     """
@@ -47,6 +93,41 @@ class StreamStop(Enum):
     STOP = hash(hash)
 
 
+class StreamQueue(asyncio.Queue):
+    """
+    Queue bounded by the total size of queued data instead of number of items
+    """
+
+    def __init__(self, maxbytes: int = STREAM_BUFFER_SIZE):
+        super().__init__()
+
+        self._bytes = 0
+        self._maxbytes = maxbytes
+
+    def full(self) -> bool:
+        return self._bytes >= self._maxbytes
+
+    def qbytes(self) -> int:
+        """
+        Total size of queued data
+        """
+        return self._bytes
+
+    def _put(self, item):
+        if item != StreamStop.STOP:
+            self._bytes += len(item)
+
+        super()._put(item)
+
+    def _get(self):
+        item = super()._get()
+
+        if item != StreamStop.STOP:
+            self._bytes -= len(item)
+
+        return item
+
+
 class GitCapabilities(str, Enum):
     """
     Supported server capabilities.
@@ -59,9 +140,27 @@ class GitCapabilities(str, Enum):
     AllowTipSha1 = "allow-tip-sha1-in-want"
     SymRef = "symref=HEAD:refs/heads/{}"
     NoProgress = "no-progress"
+    OfsDelta = "ofs-delta"
+    MultiAck = "multi_ack"
+    MultiAckDetailed = "multi_ack_detailed"
+    Shallow = "shallow"
+    DeepenSince = "deepen-since"
+    DeepenRelative = "deepen-relative"
     Agent = "agent=git/fakegit"
 
 
+class GitCapabilitiesV2(str, Enum):
+    """
+    Server capabilities advertised in protocol version 2.
+    Reference: https://git-scm.com/docs/protocol-v2#_capabilities
+    """
+
+    Agent = "agent=git/fakegit"
+    LsRefs = "ls-refs"
+    Fetch = "fetch=shallow"
+    ObjectFormat = "object-format=sha1"
+
+
 class GitSideBandType(Enum):
     """
     Types of sideband protocol packets
@@ -80,6 +179,16 @@ class GitCommandType(str, Enum):
     UploadPack = "git-upload-pack"
 
 
+class GitCommandV2(str, Enum):
+    """
+    Supported protocol version 2 commands.
+    Reference: https://git-scm.com/docs/protocol-v2
+    """
+
+    LsRefs = "ls-refs"
+    Fetch = "fetch"
+
+
 class GitSmartHTTPRequest(Request):
     """
     Validates git client requests
@@ -101,19 +210,45 @@ class GitSmartHTTPRequest(Request):
 
                 # this looks like proper git client request
                 if (
-                    self.headers["content-type"] == req
-                    and self.headers["accept"] == res
+                    self.headers.get("content-type") == req
+                    and self.headers.get("accept") == res
                 ):
                     self._valid = True
                     break
 
             if not self._valid:
                 logger.error(
-                    "invalid content-type in POST: ", self.headers["content-type"]
+                    f"invalid content-type in POST: {self.headers.get('content-type')}"
                 )
 
                 raise HTTPException(400)
 
+    async def stream_decoded(self) -> AsyncIterator[bytes]:
+        """
+        Stream request body, decompressing it if needed;
+        git compresses requests bigger than 1KB with gzip
+        """
+        if self.headers.get("content-encoding") != "gzip":
+            async for chunk in self.stream():
+                yield chunk
+
+            return
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        async for chunk in self.stream():
+            yield decompressor.decompress(chunk)
+
+        yield decompressor.flush()
+
+    def get_protocol_version(self) -> int:
+        """
+        Returns protocol version requested by the client, 0 by default
+        """
+        params = self.headers.get("git-protocol", "").split(":")
+
+        return 2 if "version=2" in params else 0
+
 
 class GitSmartHTTPResponse(Response):
     """
@@ -151,6 +286,7 @@ class GitCommandResponse(GitSmartHTTPResponse, StreamingResponse):
     """
 
     _queue = None
+    _producer = None
     media_type = "application/x-{command}-result"
 
     def __init__(self, queue: asyncio.Queue, *args, **kwargs):
@@ -158,6 +294,34 @@ class GitCommandResponse(GitSmartHTTPResponse, StreamingResponse):
 
         super().__init__(content=self.generate_stream(), *args, **kwargs)
 
+    def start(self, producer: Coroutine):
+        """
+        Run producer which fills the queue in background
+        """
+        self._producer = asyncio.create_task(self.produce(producer))
+
+    async def produce(self, producer: Coroutine):
+        """
+        Await producer and make sure stream ends even if it fails
+        """
+        try:
+            await producer
+        except Exception:
+            logger.exception("response producer failed")
+
+            await self._queue.put(StreamStop.STOP)
+
+    async def __call__(self, *args, **kwargs):
+        # stream ends either when producer is done or client has gone away,
+        # and in the latter case producer is stuck waiting on a full queue
+        try:
+            await super().__call__(*args, **kwargs)
+        finally:
+            if self._producer is not None and not self._producer.done():
+                logger.info("client has disconnected, cancelling response producer")
+
+                self._producer.cancel()
+
     async def generate_stream(self, *args, **kwargs):
         """
         Stream queue contents to the consumer
@@ -181,6 +345,14 @@ class GitSmartProtocol:
     _pkt = None
     _caps = []
     _refs = set()
+    _haves = []
+    _done = False
+    _command = None
+    _arguments = []
+    _shallow = set()
+    _depth = None
+    _since = None
+    _relative = False
     _reader = None
     _writer = None
     _streamable = False
@@ -218,51 +390,174 @@ class GitSmartProtocol:
             return self._refs, self._caps
 
         refs = set()
+        haves = []
         has_done = False
+        command = None
+        arguments = []
+        shallow = set()
+        depth = None
+        since = None
+        relative = False
+        caps = set()
         negotiated_caps = set()
-        body = await self._reader.body()
-
-        for line in self._pkt.parse(body):
-            if line.startswith("want"):
-                data = line.split(" ")
-                refs.add(data[1].replace(" ", ""))
-                caps = data[1:]
-
-                # determine whether progress should be printed and sideband used;
-                # https://git-scm.com/docs/pack-protocol/2.13.7#_packfile_data
-                for cap in caps:
-                    if cap == GitCapabilities.NoProgress.value:
-                        negotiated_caps.add(GitCapabilities.NoProgress)
-                    if GitCapabilities.SideBand.value in caps:
-                        negotiated_caps.add(GitCapabilities.SideBand)
-                        self._max_sideband_size = 999
-                    elif GitCapabilities.SideBand64k.value in caps:
-                        negotiated_caps.add(GitCapabilities.SideBand64k)
-                        self._max_sideband_size = 65519
-
-                # that should be impossible
-                if (
-                    GitCapabilities.SideBand in caps
-                    and GitCapabilities.SideBand64k in caps
-                ):
-                    logger.error("cannot use two sidebands at once")
-                    raise HTTPException(400)
+        reader = PktLineReader()
+        version = self._reader.get_protocol_version()
+
+        try:
+            async for kind, line in reader.read(self._reader.stream_decoded()):
+                if kind != PktLineType.data:
+                    continue
+
+                words = bytes(line).decode("ascii").split()
+
+                if not words:
+                    continue
+
+                # in version 0 capabilities are sent along with the first want
+                if words[0] == "want" and len(words) > 1:
+                    refs.add(words[1])
+                    caps.update(words[2:])
+
+                elif words[0] == "have" and len(words) > 1:
+                    have = words[1]
+
+                    if len(have) != 40 or not all(c in hexdigits for c in have):
+                        raise GitError(f"invalid have: {have}")
+
+                    haves.append(have)
+
+                elif words[0] == "done":
+                    has_done = True
+
+                # shallow commits client already has
+                elif words[0] == "shallow" and len(words) > 1:
+                    shallow.add(words[1])
+
+                elif words[0] == "deepen" and len(words) > 1:
+                    depth = int(words[1])
+
+                    if depth < 1:
+                        raise GitError(f"invalid depth {depth}")
 
-            if line == "done":
-                has_done = True
+                elif words[0] == "deepen-since" and len(words) > 1:
+                    since = int(words[1])
 
-        # malformed request
-        if not has_done:
+                elif words[0] == "deepen-relative":
+                    relative = True
+
+                # in version 2 each command argument is on its own line
+                elif version == 2:
+                    if words[0].startswith("command="):
+                        command = words[0][8:]
+                    else:
+                        arguments.append(words)
+                        caps.add(words[0])
+
+        except (GitError, UnicodeDecodeError, ValueError, zlib.error) as e:
+            logger.error(f"malformed request: {e}")
+            raise HTTPException(400)
+
+        # version 0 sends it as a capability
+        if GitCapabilities.DeepenRelative.value in caps:
+            relative = True
+
+        # determine whether progress should be printed and sideband used;
+        # https://git-scm.com/docs/pack-protocol/2.13.7#_packfile_data
+        for cap in (
+            GitCapabilities.NoProgress,
+            GitCapabilities.OfsDelta,
+            GitCapabilities.MultiAck,
+            GitCapabilities.MultiAckDetailed,
+        ):
+            if cap.value in caps:
+                negotiated_caps.add(cap)
+
+        # that should be impossible
+        if (
+            GitCapabilities.SideBand.value in caps
+            and GitCapabilities.SideBand64k.value in caps
+        ):
+            logger.error("cannot use two sidebands at once")
+            raise HTTPException(400)
+
+        # version 2 always sends packfile over side-band-64k;
+        # limits include pkt-line header and sideband type byte
+        if GitCapabilities.SideBand.value in caps:
+            negotiated_caps.add(GitCapabilities.SideBand)
+            self._max_sideband_size = 1000 - 5
+        elif GitCapabilities.SideBand64k.value in caps or version == 2:
+            negotiated_caps.add(GitCapabilities.SideBand64k)
+            self._max_sideband_size = PKTLINE_MAX_SIZE - 5
+
+        if version == 2:
+            if command not in (GitCommandV2.LsRefs, GitCommandV2.Fetch):
+                logger.error(f"unsupported command: {command}")
+                raise HTTPException(400)
+
+        # malformed request; without "done" and haves there's nothing to negotiate,
+        # except for shallow requests, which are answered with shallow commits first
+        elif not has_done and not haves and depth is None and since is None:
             logger.error("no preliminary request termination")
             raise HTTPException(400)
 
         # update refs & sideband info
         self._refs = refs
+        self._haves = haves
+        self._done = has_done
+        self._command = command
+        self._arguments = arguments
+        self._shallow = shallow
+        self._depth = depth
+        self._since = since
+        self._relative = relative
         self._caps = negotiated_caps
         self._cached_request = True
 
         return refs, negotiated_caps
 
+    def get_shallow(self) -> set[str]:
+        """
+        Returns shallow commits which client already has
+        """
+        return self._shallow
+
+    def get_deepen(self) -> tuple[int | None, int | None, bool]:
+        """
+        Returns requested history depth and oldest commit time, if any,
+        and whether depth is relative to the current shallow commits
+        """
+        return self._depth, self._since, self._relative
+
+    def is_deepen(self) -> bool:
+        """
+        Checks whether client has requested shallow history
+        """
+        return self._depth is not None or self._since is not None
+
+    def get_command(self) -> str | None:
+        """
+        Returns requested command, only version 2 requests have one
+        """
+        return self._command
+
+    def get_arguments(self) -> list[list[str]]:
+        """
+        Returns version 2 command arguments, split into words
+        """
+        return self._arguments
+
+    def get_haves(self) -> list[str]:
+        """
+        Returns objects which client has, in the order they were sent
+        """
+        return self._haves
+
+    def is_done(self) -> bool:
+        """
+        Checks whether client has finished negotiation and expects a packfile
+        """
+        return self._done
+
     async def add_raw(self, data: bytes):
         """
         Write raw data to the output buffer
@@ -274,6 +569,12 @@ class GitSmartProtocol:
             self._writer.body += data
             self._writer.headers["content-length"] = str(len(self._writer.body))
 
+    async def add_delim(self):
+        """
+        Add delimiter packet, which separates response sections in version 2
+        """
+        await self.add_raw(f"{PktLineType.delim.value:04x}".encode("ascii"))
+
     async def stop_stream(self):
         """
         Indicate that stream has ended
@@ -295,14 +596,14 @@ class GitSmartProtocol:
 
         await self.add_raw(line)
 
-    async def add_sideband(self, kind: GitSideBandType, data: bytes | str):
+    async def add_sideband(self, kind: GitSideBandType, data: bytes | memoryview | str):
         """
         Add sideband data packet to the output buffer
         """
         if len(data) > self._max_sideband_size:
             raise GitError("sideband data is too large")
 
-        encoded = data if isinstance(data, bytes) else data.encode("ascii")
+        encoded = data.encode("ascii") if isinstance(data, str) else data
 
         # CR ensures that git can use terminal escape codes to format
         # nice progress messages. Newline (LF, \n) is mandatory to
@@ -313,9 +614,264 @@ class GitSmartProtocol:
         await self.add_line(kind.value + encoded + trailer)
 
 
-async def pack_and_sideband_handler(data: SessionData, proto: GitSmartProtocol):
+def get_packfile_data(data: SessionData) -> bytes | memoryview:
+    """
+    Return plain packfile contents. Framed packfile has to be unpacked
+    from its frames into a copy, plain one is returned as is
+    """
+    if not data.framed:
+        return data.packfile
+
+    return b"".join(iter_packfile_data(data, len(data.packfile)))
+
+
+def iter_packfile_data(data: SessionData, size: int) -> Iterator[memoryview]:
+    """
+    Iterate over packfile contents in pieces of at most given size.
+    Framed packfile is unpacked from its frames without copying
+    """
+    if data.framed:
+        frames = PktLineReader().feed(data.packfile)
+        payloads = (frame[1:] for _, frame in frames)
+    else:
+        payloads = [memoryview(data.packfile)]
+
+    for payload in payloads:
+        for i in range(0, len(payload), size):
+            yield payload[i : i + size]
+
+
+@functools.lru_cache(maxsize=ADVERTISEMENT_CACHE_SIZE)
+def make_advertisement(service: str, head: str, branch: str) -> bytes:
+    """
+    Create refs advertisement body. It only depends on the branch head,
+    so it's built once and then served from cache
+    """
+    pkt = PktLine()
+    caps = []
+
+    # prepare caps array
+    for cap in GitCapabilities:
+        value = cap.value
+
+        # update branch in symref
+        if cap == GitCapabilities.SymRef:
+            value = value.format(branch)
+
+        caps.append(value)
+
+    return b"".join(
+        [
+            # set service name
+            pkt.write(f"# service={service}\n"),
+            pkt.write(None),
+            # latest ref and caps
+            pkt.write(f"{head} HEAD\x00{' '.join(caps)}\n"),
+            pkt.write(f"{head} refs/heads/{branch}\n"),
+            pkt.write(None),
+        ]
+    )
+
+
+@functools.cache
+def make_advertisement_v2() -> bytes:
+    """
+    Create version 2 capabilities advertisement, which is the same for all repos
+    """
+    pkt = PktLine()
+    lines = [pkt.write("version 2\n")]
+
+    for cap in GitCapabilitiesV2:
+        lines.append(pkt.write(f"{cap.value}\n"))
+
+    lines.append(pkt.write(None))
+
+    return b"".join(lines)
+
+
+async def negotiation_handler(index: GitPackIndex, proto: GitSmartProtocol):
+    """
+    Reply to a negotiation round: acknowledge every common object and finish
+    with NAK, as multi_ack requires. Stateless client will send another request
+    with all common objects included, so nothing is remembered between rounds.
+    Since history is linear, any common commit is enough to build a pack,
+    which is reported to the client as "ready" in multi_ack_detailed mode.
+    """
+    _, caps = await proto.parse_request()
+    detailed = GitCapabilities.MultiAckDetailed in caps
+    common = None
+    other = False
+
+    for have in proto.get_haves():
+        if index.find(have) >= 0:
+            common = have
+            status = "common" if detailed else "continue"
+
+            await proto.add_line(f"ACK {have} {status}\n")
+        else:
+            other = True
+
+            if common:
+                status = "ready" if detailed else "continue"
+
+                await proto.add_line(f"ACK {have} {status}\n")
+
+    if detailed and common and not other:
+        await proto.add_line(f"ACK {common} ready\n")
+
+    await proto.add_line("NAK\n")
+    await proto.stop_stream()
+
+
+async def acknowledgments_handler(
+    proto: GitSmartProtocol, common: list[str], ready: bool
+):
     """
-    Main function to format sideband messages and send a prepared packfile
+    Write acknowledgments section of version 2 fetch response. If server is ready
+    to send a packfile, it follows in the next section, otherwise response ends.
+    """
+    await proto.add_line("acknowledgments\n")
+
+    for have in common:
+        await proto.add_line(f"ACK {have}\n")
+
+    if not common:
+        await proto.add_line("NAK\n")
+
+    if ready:
+        await proto.add_line("ready\n")
+        await proto.add_delim()
+    else:
+        await proto.add_line(None)
+        await proto.stop_stream()
+
+
+async def ls_refs_handler(data: SessionData, proto: GitSmartProtocol):
+    """
+    List refs in response to version 2 ls-refs command
+    """
+    prefixes = []
+    symrefs = False
+    branch = f"refs/heads/{data.branch}"
+
+    for argument in proto.get_arguments():
+        if argument[0] == "ref-prefix" and len(argument) > 1:
+            prefixes.append(argument[1])
+        elif argument[0] == "symrefs":
+            symrefs = True
+
+    for name, target in (("HEAD", branch), (branch, None)):
+        if prefixes and not any(name.startswith(prefix) for prefix in prefixes):
+            continue
+
+        line = f"{data.latest_object} {name}"
+
+        if symrefs and target:
+            line += f" symref-target:{target}"
+
+        await proto.add_line(line + "\n")
+
+    await proto.add_line(None)
+    await proto.stop_stream()
+
+
+async def shallow_handler(
+    proto: GitSmartProtocol, shallow: list[str], unshallow: list[str]
+):
+    """
+    Write shallow commits boundary: shallow-update lines in version 0,
+    terminated with flush, or shallow-info section in version 2
+    """
+    version2 = proto.get_command() == GitCommandV2.Fetch
+
+    if version2:
+        await proto.add_line("shallow-info\n")
+
+    for sha1 in shallow:
+        await proto.add_line(f"shallow {sha1}\n")
+
+    for sha1 in unshallow:
+        await proto.add_line(f"unshallow {sha1}\n")
+
+    if version2:
+        await proto.add_delim()
+    else:
+        await proto.add_line(None)
+
+
+def create_partial_pack(
+    reader: GitPackReader, data: SessionData, objects: list[str]
+) -> SessionData:
+    """
+    Pack only given objects, which client doesn't have yet
+    """
+    packfile = reader.iter_pack(objects, PACK_THREADS, PACK_COMPRESSION)
+
+    return SessionData(
+        total_objects=len(objects),
+        latest_object=data.latest_object,
+        packfile=b"".join(packfile),
+        total_deltas=packfile.get_deltas(),
+    )
+
+
+class GitProgress:
+    """
+    Reports packfile transfer progress in sideband messages, like git does.
+    Messages are queued right after the data they account for, so client
+    sees the amount of data it has actually received.
+    """
+
+    _proto = None
+    _total = 0
+    _sent = 0
+    _percent = -1
+    _enabled = False
+
+    def __init__(self, proto: GitSmartProtocol, total: int, enabled: bool = True):
+        self._proto = proto
+        self._total = max(total, 1)
+        self._enabled = enabled
+
+    async def report(self, trailer: str = ""):
+        """
+        Write current progress line
+        """
+        await self._proto.add_sideband(
+            GitSideBandType.Message,
+            f"Sending pack: {self._percent:3}% "
+            f"({self._sent // 1024}/{self._total // 1024} KiB){trailer}",
+        )
+
+    async def update(self, count: int):
+        """
+        Account for sent data, message is written once per percent
+        """
+        self._sent = min(self._sent + count, self._total)
+        percent = self._sent * 100 // self._total
+
+        if self._enabled and percent != self._percent:
+            self._percent = percent
+
+            await self.report()
+
+    async def finish(self):
+        """
+        Write final progress line
+        """
+        self._sent = self._total
+        self._percent = 100
+
+        if self._enabled:
+            await self.report(", done.\n")
+
+
+async def pack_and_sideband_handler(
+    data: SessionData, proto: GitSmartProtocol, ack: str | None = None
+):
+    """
+    Main function to format sideband messages and send a prepared packfile.
+    Last common object is acknowledged if there's any, otherwise NAK is sent.
     """
     # identify requested capabilities
     _, caps = await proto.parse_request()
@@ -323,6 +879,7 @@ async def pack_and_sideband_handler(data: SessionData, proto: GitSmartProtocol):
     has_progress = True
     has_fancy = True
     total = data.total_objects
+    deltas = data.total_deltas
 
     if GitCapabilities.SideBand in caps or GitCapabilities.SideBand64k in caps:
         has_sideband = True
@@ -332,8 +889,11 @@ async def pack_and_sideband_handler(data: SessionData, proto: GitSmartProtocol):
         has_progress = False
         logger.info("no-progress is requested, no status output will be done")
 
-    # send initial NAK
-    await proto.add_line("NAK\n")
+    # finish negotiation; in version 2 it's done in a separate section
+    if proto.get_command() == GitCommandV2.Fetch:
+        await proto.add_line("packfile\n")
+    else:
+        await proto.add_line(f"ACK {ack}\n" if ack else "NAK\n")
 
     # emulate real git
     if has_sideband and has_progress:
@@ -343,6 +903,10 @@ async def pack_and_sideband_handler(data: SessionData, proto: GitSmartProtocol):
         ]
 
         for message in messages:
+            if CLONE_FAST_PATH:
+                await proto.add_sideband(GitSideBandType.Message, message + "\n")
+                continue
+
             for i in range(0, len(message) + 1):
                 await proto.add_sideband(GitSideBandType.Message, message[0:i])
                 await asyncio.sleep(0.05)
@@ -353,9 +917,10 @@ async def pack_and_sideband_handler(data: SessionData, proto: GitSmartProtocol):
             GitSideBandType.Message, f"Enumerating objects: {total}, done.\n"
         )
 
+    # emulate real git even harder
+    if has_sideband and has_progress and not CLONE_FAST_PATH:
         step = int(total / 100) + 1
 
-        # emulate real git even harder
         for i in range(0, total + 1, step):
             percent = int(i / total * 100)
 
@@ -371,23 +936,34 @@ async def pack_and_sideband_handler(data: SessionData, proto: GitSmartProtocol):
     # in sideband mode, packfile is chunked and interleaved with sideband messages
     # https://git-scm.com/docs/pack-protocol/2.13.7#_packfile_data
     if has_sideband:
-        i = 0
-        size = len(data.packfile)
-        chunk_size = proto.get_sideband_size() // 2
+        progress = GitProgress(proto, len(data.packfile), has_progress)
+
+        if data.framed and GitCapabilities.SideBand64k in caps:
+            # packfile is stored as ready side-band-64k frames
+            view = memoryview(data.packfile)
+
+            for i in range(0, len(view), PKTLINE_MAX_SIZE):
+                await proto.add_raw(view[i : i + PKTLINE_MAX_SIZE])
+                await progress.update(PKTLINE_MAX_SIZE)
+        else:
+            size = proto.get_sideband_size()
+
+            for chunk in iter_packfile_data(data, size):
+                await proto.add_sideband(GitSideBandType.PackData, chunk)
+                await progress.update(len(chunk))
 
-        for i in range(0, size, chunk_size):
-            chunk = data.packfile[i : i + chunk_size]
-            await proto.add_sideband(GitSideBandType.PackData, chunk)
+        await progress.finish()
 
         # final sideband message
         if has_progress:
             await proto.add_sideband(
                 GitSideBandType.Message,
-                f"Total {total} (delta 0), reused 0 (delta 0), pack-reused 0\n",
+                f"Total {total} (delta {deltas}), reused 0 (delta 0), pack-reused 0\n",
             )
     else:
         # if there's no sideband, packfile is sent raw (why...)
-        await proto.add_raw(data.packfile)
+        for chunk in iter_packfile_data(data, PKTLINE_MAX_SIZE):
+            await proto.add_raw(chunk)
 
     # sideband requires explicit flush packet
     if has_sideband:
@@ -411,10 +987,10 @@ class GitClientRoute(APIRoute):
         return custom_route_handler
 
 
-# create git router
+# create git router; repo ID is verified by each route,
+# discovery does it along with reading the repo data
 GitRouter = APIRouter(
-    prefix="/repo/{repo_id}",
-    dependencies=[Depends(verify_repo_id)],
+    prefix=GIT_PREFIX + "/{repo_id}",
     include_in_schema=True,
 )
 
@@ -422,6 +998,80 @@ GitRouter = APIRouter(
 GitRouter.route_class = GitClientRoute
 
 
+class GitClientApp:
+    """
+    Lean ASGI application which serves git clients directly, without FastAPI
+    routing, dependencies and middlewares. Requests to other paths, as well
+    as lifespan events, are passed to the wrapped application.
+    """
+
+    _app = None
+    _prefix = None
+    _context = None
+
+    def __init__(self, app: Callable, prefix: str = GIT_PREFIX):
+        self._app = app
+        self._prefix = prefix + "/"
+
+        # git requests are identified the same way main app does it
+        self._context = RawContextMiddleware(
+            self.serve, plugins=(plugins.RequestIdPlugin(),)
+        )
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable):
+        if scope["type"] != "http" or not scope["path"].startswith(self._prefix):
+            return await self._app(scope, receive, send)
+
+        await self._context(scope, receive, send)
+
+    async def serve(self, scope: dict, receive: Callable, send: Callable):
+        """
+        Respond to git client, who may go away at any point
+        """
+        try:
+            try:
+                response = await self.dispatch(scope, receive)
+            except HTTPException as e:
+                response = Response(status_code=e.status_code)
+
+            await response(scope, receive, send)
+        except ClientDisconnect:
+            logger.info("client has disconnected")
+
+    async def dispatch(self, scope: dict, receive: Callable) -> Response:
+        """
+        Validate request and call the matching handler
+        """
+        repo_id, _, path = scope["path"][len(self._prefix) :].partition("/")
+        method = scope["method"]
+
+        if len(repo_id) != SESSION_ID_LENGTH:
+            raise HTTPException(404)
+
+        request = GitSmartHTTPRequest(scope, receive)
+
+        # discovery handler verifies repo ID itself
+        if path == "info/refs" and method == "GET":
+            try:
+                service = GitCommandType(request.query_params.get("service"))
+            except ValueError:
+                raise HTTPException(400)
+
+            return await discovery_handler(repo_id, service, request)
+
+        if method == "POST":
+            try:
+                command = GitCommandType(path)
+            except ValueError:
+                raise HTTPException(404)
+
+            await verify_repo_id(repo_id)
+
+            return await refs_handler(repo_id, command, request)
+
+        raise HTTPException(404)
+
+
 @GitRouter.get("/info/refs")
 async def discovery_handler(
     repo_id: str, service: GitCommandType, request: GitSmartHTTPRequest
@@ -429,45 +1079,91 @@ async def discovery_handler(
     """
     Handle initial discovery request from a client
     """
-    response = GitDiscoveryResponse(service.value)
-    proto = GitSmartProtocol(reader=request, writer=response)
+    # version 2 advertises only capabilities, refs are listed with ls-refs;
+    # git itself doesn't send service name in this case, so do the same
+    if request.get_protocol_version() == 2:
+        await verify_repo_id(repo_id)
 
-    caps = []
-    session = SessionStore.create_session_from_uri(repo_id)
-    data = await session.get_data()
+        return GitDiscoveryResponse(service.value, content=make_advertisement_v2())
 
-    # get some git params
-    head = data.latest_object
-    branch = data.branch
+    # only branch head is needed here, so packfile is not loaded;
+    # repo ID is verified in the same round trip
+    data = await get_repo_metadata(repo_id)
+    content = make_advertisement(service.value, data.latest_object, data.branch)
 
-    # prepare caps array
-    for cap in GitCapabilities:
-        value = cap.value
+    return GitDiscoveryResponse(service.value, content=content)
 
-        # update branch in symref
-        if cap == GitCapabilities.SymRef:
-            value = value.format(branch)
 
-        caps.append(value)
+async def fetch_handler(
+    session: Session, data: SessionData, proto: GitSmartProtocol, version: int
+):
+    """
+    Negotiate common objects with the client and send a packfile once it's ready
+    """
+    # without haves it's a clone, and the stored packfile is sent as is.
+    # otherwise the commit chain is walked to find what client is missing
+    haves = proto.get_haves()
+    deepen = proto.is_deepen()
+    ack = None
+
+    if haves or deepen:
+        # haves are checked against the index, packfile is
+        # loaded only if a new pack is going to be created
+        index = GitPackIndex(await session.get_index())
+        common = [have for have in haves if index.find(have) >= 0]
+
+        # history is linear, so any common commit is enough to create a pack;
+        # version 2 allows to send it right away, without another round
+        if version == 2 and not proto.is_done():
+            await acknowledgments_handler(proto, common, bool(common))
+
+            if not common:
+                return
+
+        elif not proto.is_done() and not deepen:
+            await negotiation_handler(index, proto)
+
+            return
+
+        if common or deepen:
+            depth, since, relative = proto.get_deepen()
+            data.packfile = await session.get_packfile(data.pack_digest, data.framed)
+            reader = GitPackReader(get_packfile_data(data), index)
+
+            # walking and repacking may take a while for long histories
+            objects, shallow, unshallow = await asyncio.to_thread(
+                reader.find_missing,
+                [data.latest_object],
+                common,
+                proto.get_shallow(),
+                depth,
+                since,
+                relative,
+            )
 
-    # set service name
-    await proto.add_line(f"# service={service.value}\n")
-    await proto.add_line(None)
+            # in version 0 shallow commits are sent in every response, first
+            if deepen:
+                await shallow_handler(proto, shallow, unshallow)
 
-    # latest ref and caps
-    await proto.add_line(
-        f"{head} HEAD".encode("ascii")
-        + b"\x00"
-        + str(" ").join(caps).encode("ascii")
-        + b"\n"
-    )
-    await proto.add_line(f"{head} refs/heads/{branch}\n")
-    await proto.add_line(None)
+            if not proto.is_done() and version == 0:
+                if haves:
+                    await negotiation_handler(index, proto)
+                else:
+                    await proto.stop_stream()
 
-    return response
+                return
 
+            ack = common[-1] if common else None
+            data = await asyncio.to_thread(create_partial_pack, reader, data, objects)
 
-@GitRouter.post("/{command}")
+    # no new pack has been created, so the stored one is sent
+    if data.packfile is None:
+        data.packfile = await session.get_packfile(data.pack_digest, data.framed)
+
+    await pack_and_sideband_handler(data, proto, ack)
+
+
+@GitRouter.post("/{command}", dependencies=[Depends(verify_repo_id)])
 async def refs_handler(
     repo_id: str, command: GitCommandType, request: GitSmartHTTPRequest
 ):
@@ -475,34 +1171,41 @@ async def refs_handler(
     Handle pack downloading and sideband channel
     """
     # prepare response and initialize proto
-    queue = asyncio.Queue()
+    queue = StreamQueue()
     response = GitCommandResponse(queue=queue, cmdname=command.value)
     proto = GitSmartProtocol(reader=request, writer=queue)
 
     # parse initial request here, since it won't be easy to raise an exception later
-    # NB: repo_id is a valid session_id, which was already verified in router deps
+    # NB: repo_id is a valid session_id, which was already verified in route deps
     session = SessionStore.create_session_from_uri(repo_id)
-    data = await session.get_data()
-    refs, _ = await proto.parse_request()
+    refs, caps = await proto.parse_request()
+    version = request.get_protocol_version()
+
+    # packfile is loaded later, and only if it's actually needed
+    data = await session.get_metadata()
+
+    if proto.get_command() == GitCommandV2.LsRefs:
+        response.start(ls_refs_handler(data, proto))
+
+        return response
 
     if len(refs) == 0:
         logger.error("no refs specified")
         raise HTTPException(400)
 
-    # in theory, a graph walking is required
-    # to determine exact objects which are needed
-    # by a particular ref that a client has requested.
-    # in practice, this code supports only full clone,
-    # so all objects will be packed and returned.
+    # packfile is stored with commits deltified against each other
+    if data.total_deltas and GitCapabilities.OfsDelta not in caps:
+        logger.error("client doesn't support ofs-delta")
+        raise HTTPException(400)
+
+    # there's only one branch, so only its head can be requested
     if not data.latest_object in refs:
         logger.error(f"unknown ref requested: {data.latest_object}")
         raise HTTPException(400)
 
-    # request looks valid, schedule actual handler
-    # NB: not sure if fastapi/starlette BackgroundTasks should
-    # be used here, but they do not seem to work. At least
-    # asyncio picks up the function right away
-    asyncio.create_task(pack_and_sideband_handler(data, proto))
+    # request looks valid, schedule actual handler, which is
+    # cancelled if the client disconnects before it's finished
+    response.start(fetch_handler(session, data, proto, version))
 
     # return early
     return response
@@ -1,17 +1,21 @@
 import os
+import re
 import logging
 import datetime
 
-from typing import Annotated
+from typing import Annotated, Iterable, Iterator
 
 from jinja2 import Template
 from fastapi import Path, Request, HTTPException
 from fastapi.responses import JSONResponse
 
-from session import SessionStore, SessionError, SESSION_ID_LENGTH
+from session import SessionStore, SessionData, SessionError, SESSION_ID_LENGTH
 
 TEMPLATE_NAME = "readme.md.jinja2"
 
+# only a single range of bytes is supported
+RANGE_REGEX = re.compile(r"bytes=(\d*)-(\d*)")
+
 
 class GitoborosException(HTTPException):
     """
@@ -35,7 +39,7 @@ async def gitoboros_exception_handler(request: Request, exc: GitoborosException)
 async def verify_repo_id(
     repo_id: Annotated[
         str, Path(min_length=SESSION_ID_LENGTH, max_length=SESSION_ID_LENGTH)
-    ]
+    ],
 ):
     """
     Dependency to verify externally provided repo (session) ID
@@ -59,12 +63,88 @@ async def verify_repo_id(
         raise HTTPException(404)
 
 
-def render_readme(account, branch):
+async def get_repo_metadata(repo_id: str) -> SessionData:
+    """
+    Same as verify_repo_id, but also returns repo (session) data
+    without the packfile, which is read in the same round trip
+    """
+    data = None
+    logger = logging.getLogger("repo_check")
+
+    try:
+        session = SessionStore.create_session_from_uri(repo_id)
+        data = await session.get_valid_metadata()
+
+    # invalid ID provided
+    except SessionError:
+        pass
+
+    if data is None:
+        logger.error(f"no such repo: {repo_id}")
+        raise HTTPException(404)
+
+    return data
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parse Range header and return start and end (exclusive) of requested bytes.
+    None is returned if the header can't be handled and the whole content
+    should be sent instead, as permitted by RFC 9110.
+    """
+    match = RANGE_REGEX.fullmatch(header.strip())
+
+    if not match or match.groups() == ("", ""):
+        return None
+
+    first, last = match.groups()
+
+    # suffix range, i.e. last N bytes
+    if not first:
+        start, end = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+
+    if start >= size or start >= end:
+        raise HTTPException(416, headers={"content-range": f"bytes */{size}"})
+
+    return start, end
+
+
+def iter_range(
+    chunks: Iterable[bytes | memoryview], start: int, end: int
+) -> Iterator[bytes | memoryview]:
+    """
+    Iterate over a part of content split into chunks, from start till end
+    """
+    offset = 0
+
+    for chunk in chunks:
+        size = len(chunk)
+
+        if offset + size > start and offset < end:
+            yield chunk[max(start - offset, 0) : end - offset]
+
+        offset += size
+
+        if offset >= end:
+            break
+
+
+def render_readme(account, branch, timestamp=None):
     current = os.path.dirname(__file__)
-    utcnow = datetime.datetime.utcnow()
+
+    if timestamp is None:
+        utcnow = datetime.datetime.utcnow()
+    else:
+        utcnow = datetime.datetime.utcfromtimestamp(timestamp)
+
     rfc2822 = utcnow.strftime("%a, %d %b %Y %H:%m:%S GMT")
 
     with open(os.path.join(current, TEMPLATE_NAME)) as file:
         template = Template(file.read())
 
-    return template.render(account=account, branch=branch, timestamp=rfc2822).encode("ascii")
+    return template.render(account=account, branch=branch, timestamp=rfc2822).encode(
+        "ascii"
+    )
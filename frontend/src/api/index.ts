@@ -17,6 +17,7 @@ type MigrationRequest = {
 /* response which's returned by this method */
 type MigrationSuccessResponse = {
   repo: string;
+  path: string;
   expires: number;
 }
 
@@ -29,6 +30,7 @@ type MigrationErrorResponse = {
 type APIResponseSuccess = {
   repo_id: string;
   repo_ttl: number;
+  repo_path: string;
 };
 
 /* formatted API errors are wrapped in this */
@@ -72,6 +74,7 @@ async function submitMigrationRequest(handle: string, email: string, branch: str
 
         resolve({
           repo: data.repo_id,
+          path: data.repo_path,
           expires: data.repo_ttl,
         })
       } catch (error) {
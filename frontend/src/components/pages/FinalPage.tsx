@@ -49,13 +49,13 @@ const SuccessScreen = () => {
   const dispatch = useAppDispatch();
 
   const username = useAppSelector((state) => state.data.handle);
-  const repo_uri = useAppSelector((state) => state.data.repo?.uri) as string;
+  const repo_path = useAppSelector((state) => state.data.repo?.path) as string;
   const repo_exp = useAppSelector((state) => state.data.repo?.expires) as number;
 
   const [willExpire, setWillExpire] = useState(repo_exp);
   const [isTooltipVisible, setIsTooltipVisible] = useState(false);
 
-  const repoURL = window.location.protocol + '//' + window.location.host + '/repo/' + repo_uri;
+  const repoURL = window.location.protocol + '//' + window.location.host + repo_path;
 
   useEffect(() => {
     const interval = setInterval(() => {
@@ -28,6 +28,7 @@ interface DataState {
   /* API success values */
   repo: {
     uri: string;
+    path: string;
     expires: number;
   } | null;
 }
@@ -113,6 +114,7 @@ export const dataSlice = createSlice({
 
       state.repo = {
         uri: action.payload.repo,
+        path: action.payload.path,
         expires: action.payload.expires,
       }
       //state.finalMessage = action.payload.message;